@@ -1,13 +1,45 @@
 # -*- coding: utf-8 -*-
+import datetime
+
+from django.conf.urls.defaults import patterns, url
 from django.contrib import admin
-from emailauth.models import UserEmail
+from django.shortcuts import render_to_response
+from django.template import RequestContext
+
+from emailauth.models import UserEmail, PasswordResetToken
+from emailauth.stats import get_stats
 
 
 class UserEmailAdmin(admin.ModelAdmin):
     model = UserEmail
-    list_display = ['user', 'email', 'verified',]
+    list_display = ['user', 'email', 'verified', 'bounced',]
+    list_filter = ['verified', 'bounced',]
+
+    def get_urls(self):
+        urls = super(UserEmailAdmin, self).get_urls()
+        return patterns('',
+            url(r'^stats/$', self.admin_site.admin_view(self.stats_view),
+                name='emailauth_useremail_stats'),
+        ) + urls
+
+    def stats_view(self, request):
+        stats = get_stats(refresh='refresh' in request.GET)
+        return render_to_response('admin/emailauth/useremail/stats.html', {
+                'stats': stats,
+                'computed_at': datetime.datetime.fromtimestamp(
+                    stats['computed_at']),
+                'opts': self.model._meta,
+                'app_label': self.model._meta.app_label,
+            },
+            context_instance=RequestContext(request))
+
+
+class PasswordResetTokenAdmin(admin.ModelAdmin):
+    model = PasswordResetToken
+    list_display = ['user_email', 'expires_at', 'expired',]
 
 try:
     admin.site.register(UserEmail, UserEmailAdmin)
+    admin.site.register(PasswordResetToken, PasswordResetTokenAdmin)
 except admin.sites.AlreadyRegistered:
     pass
@@ -0,0 +1,181 @@
+from django.db import transaction, IntegrityError
+from django.http import HttpResponse
+from django.shortcuts import get_object_or_404
+from django.utils import simplejson
+from django.utils.functional import wraps
+from django.utils.translation import ugettext as _
+from django.views.decorators.http import require_POST
+
+from emailauth.forms import (LoginForm, RegistrationForm,
+    PasswordResetRequestForm, PasswordResetForm, AddEmailForm, DeleteEmailForm)
+from emailauth.models import UserEmail, PasswordResetToken, UserSession
+from emailauth.utils import (requires_multi_emails_mode,
+    use_stateless_registration)
+from emailauth.views import (default_register_callback, _register_email,
+    _add_email, activate_user, _verify_email, send_password_reset_email,
+    set_new_password, send_registration_email, create_registered_user,
+    login_user)
+
+
+def json_response(data, status=200):
+    response = HttpResponse(simplejson.dumps(data),
+        mimetype='application/json')
+    response.status_code = status
+    return response
+
+
+def error_response(errors, status=400):
+    return json_response({'ok': False, 'errors': errors}, status)
+
+
+def email_taken_response():
+    return error_response({'email': [_('This email is already taken.')]})
+
+
+def form_error_response(form):
+    return error_response(dict((field, [unicode(error) for error in errors])
+        for field, errors in form.errors.items()))
+
+
+def email_data(email):
+    return {
+        'id': email.id,
+        'email': email.email,
+        'verified': email.verified,
+        'default': email.default,
+    }
+
+
+def api_login_required(view):
+    def wrapper(request, *args, **kwds):
+        if not request.user.is_authenticated():
+            return error_response({'__all__': [_('Login required.')]}, 401)
+        return view(request, *args, **kwds)
+    return wraps(view)(wrapper)
+
+
+@require_POST
+def login(request):
+    form = LoginForm(request.POST)
+    if not form.is_valid():
+        return form_error_response(form)
+
+    login_user(request, form.get_user())
+    return json_response({'ok': True, 'user_id': form.get_user_id()})
+
+
+@require_POST
+def register(request, callback=default_register_callback):
+    form = RegistrationForm(request.POST)
+    if not form.is_valid():
+        return form_error_response(form)
+
+    if use_stateless_registration():
+        email_obj = send_registration_email(form)
+        return json_response({'ok': True, 'email': {'email': email_obj.email}})
+
+    try:
+        email_obj = _register_email(form, callback)
+    except IntegrityError:
+        return email_taken_response()
+    return json_response({'ok': True, 'email': email_data(email_obj)})
+
+
+@require_POST
+def verify(request, callback=activate_user):
+    verification_key = request.POST.get('verification_key', '')
+    if use_stateless_registration() and '.' in verification_key:
+        email = create_registered_user(verification_key)
+        if email is not None and callback is not None:
+            callback(request, email)
+    else:
+        email, cb_result = _verify_email(request, verification_key.lower(),
+            callback)
+    if email is None:
+        return error_response(
+            {'verification_key': [_('Invalid or expired verification key.')]},
+            404)
+    return json_response({'ok': True, 'email': email_data(email)})
+
+
+@require_POST
+def verify_code(request, callback=activate_user):
+    email, cb_result = _verify_email(request, request.POST.get('code', ''),
+        callback, request.POST.get('email', ''))
+    if email is None:
+        return error_response(
+            {'code': [_('Invalid or expired verification code.')]}, 404)
+    return json_response({'ok': True, 'email': email_data(email)})
+
+
+@require_POST
+def request_password_reset(request):
+    form = PasswordResetRequestForm(request.POST)
+    if not form.is_valid():
+        return form_error_response(form)
+
+    send_password_reset_email(form.user_email)
+    return json_response({'ok': True})
+
+
+@require_POST
+def reset_password(request):
+    token = PasswordResetToken.objects.get_valid(
+        request.POST.get('reset_code', ''))
+    if token is None:
+        return error_response(
+            {'reset_code': [_('Invalid or expired reset code.')]}, 404)
+
+    form = PasswordResetForm(request.POST)
+    if not form.is_valid():
+        return form_error_response(form)
+
+    user = set_new_password(request, token, form.cleaned_data['password1'])
+    if user is None:
+        return error_response(
+            {'reset_code': [_('Invalid or expired reset code.')]}, 404)
+    return json_response({'ok': True, 'user_id': user.id})
+
+
+@requires_multi_emails_mode
+@api_login_required
+@require_POST
+def add_email(request):
+    form = AddEmailForm(request.POST)
+    if not form.is_valid():
+        return form_error_response(form)
+
+    try:
+        email_obj = _add_email(request.user, form.cleaned_data['email'])
+    except IntegrityError:
+        return email_taken_response()
+    return json_response({'ok': True, 'email': email_data(email_obj)})
+
+
+@requires_multi_emails_mode
+@api_login_required
+@require_POST
+@transaction.commit_on_success
+def delete_email(request, email_id):
+    user_email = get_object_or_404(UserEmail, id=email_id, user=request.user,
+        verified=True)
+
+    form = DeleteEmailForm(request.user, {'yes': True})
+    if not form.is_valid():
+        return form_error_response(form)
+
+    user_email.delete()
+    UserSession.objects.invalidate(request.user, request.session.session_key)
+    return json_response({'ok': True})
+
+
+@requires_multi_emails_mode
+@api_login_required
+@require_POST
+@transaction.commit_on_success
+def set_default_email(request, email_id):
+    user_email = get_object_or_404(UserEmail, id=email_id, user=request.user,
+        verified=True)
+    user_email.default = True
+    user_email.save()
+    return json_response({'ok': True, 'email': email_data(user_email)})
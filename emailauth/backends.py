@@ -1,13 +1,16 @@
 from django.contrib.auth.models import User
 from django.contrib.auth.backends import ModelBackend
 
-from emailauth.models import UserEmail
+from emailauth.models import UserEmail, UserEmailSummary
+from emailauth import routers
 
 
 class EmailBackend(ModelBackend):
     def authenticate(self, username=None, password=None):
+        routers.check_email(username)
         try:
-            email = UserEmail.objects.get(email=username, verified=True)
+            email = UserEmail.objects.select_related('user').get(
+                email=username, verified=True)
             if email.user.check_password(password):
                 return email.user
         except UserEmail.DoesNotExist:
@@ -19,7 +22,7 @@ class FallbackBackend(ModelBackend):
         try:
             user = User.objects.get(username=username)
             if (user.check_password(password) and
-                not UserEmail.objects.filter(user=user).count()):
+                not UserEmailSummary.objects.get_for_user(user.id).email_count):
 
                 return user
 
@@ -0,0 +1,118 @@
+import fcntl
+import math
+import mmap
+import os
+import struct
+import threading
+
+from django.utils.hashcompat import md5_constructor
+
+
+class BloomFilter(object):
+    """
+    A Bloom filter stored in a flat file: a small header followed by the bit
+    array. Files are memory-mapped with a shared mapping, so bits set by one
+    process are visible to all the other processes mapping the same file.
+    Adding keys read-modify-writes bytes, so it's done under a lock of the
+    file shared by all processes.
+    """
+
+    MAGIC = 'EABF'
+    HEADER = struct.Struct('<4sQI')
+
+    def __init__(self, num_bits, num_hashes, bits, file):
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.bits = bits
+        self.file = file
+        # flock() doesn't exclude threads sharing the file descriptor
+        self.lock = threading.Lock()
+
+    @classmethod
+    def optimal_size(cls, capacity, error_rate):
+        capacity = max(capacity, 1)
+        num_bits = int(math.ceil(-capacity * math.log(error_rate) /
+            (math.log(2) ** 2)))
+        num_hashes = max(1, int(round(float(num_bits) / capacity *
+            math.log(2))))
+        return num_bits, num_hashes
+
+    @classmethod
+    def create(cls, path, capacity, error_rate):
+        num_bits, num_hashes = cls.optimal_size(capacity, error_rate)
+        f = open(path, 'wb')
+        try:
+            f.write(cls.HEADER.pack(cls.MAGIC, num_bits, num_hashes))
+            f.truncate(cls.HEADER.size + (num_bits + 7) // 8)
+        finally:
+            f.close()
+        return cls.open(path)
+
+    @classmethod
+    def open(cls, path):
+        """
+        Map an existing filter. Raises ValueError for files that aren't
+        complete Bloom filter files.
+        """
+        f = open(path, 'r+b')
+        try:
+            size = os.fstat(f.fileno()).st_size
+            if size < cls.HEADER.size:
+                raise ValueError('%s is not a Bloom filter file' % path)
+            bits = mmap.mmap(f.fileno(), 0)
+        except:
+            f.close()
+            raise
+
+        magic, num_bits, num_hashes = cls.HEADER.unpack(
+            bits[:cls.HEADER.size])
+        if (magic != cls.MAGIC or not num_bits or not num_hashes or
+            size < cls.HEADER.size + (num_bits + 7) // 8):
+
+            bits.close()
+            f.close()
+            raise ValueError('%s is not a Bloom filter file' % path)
+        return cls(num_bits, num_hashes, bits, f)
+
+    def close(self):
+        self.bits.close()
+        self.file.close()
+
+    def flush(self):
+        self.bits.flush()
+
+    def _positions(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        h1, h2 = struct.unpack('<QQ', md5_constructor(key).digest())
+        for i in xrange(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, key):
+        offset = self.HEADER.size
+        self.lock.acquire()
+        try:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+            try:
+                for position in self._positions(key):
+                    index = offset + position // 8
+                    self.bits[index] = chr(ord(self.bits[index]) |
+                        (1 << (position % 8)))
+            finally:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        finally:
+            self.lock.release()
+
+    def __contains__(self, key):
+        offset = self.HEADER.size
+        for position in self._positions(key):
+            if not ord(self.bits[offset + position // 8]) & (
+                1 << (position % 8)):
+
+                return False
+        return True
+
+
+def file_id(path):
+    stat = os.stat(path)
+    return stat.st_dev, stat.st_ino
@@ -0,0 +1,100 @@
+"""
+Reading hard bounces from mailboxes and webhook dumps.
+
+Every reader yields bounced addresses one at a time, so arbitrarily large
+sources can be processed with constant memory.
+"""
+import mailbox
+
+from django.utils import simplejson
+
+from emailauth.models import UserEmail
+
+
+def permanent_failures(message):
+    """Yield recipients of a delivery status notification that failed
+    permanently."""
+    for part in message.walk():
+        if part.get_content_type() != 'message/delivery-status':
+            continue
+        # The first block holds per-message fields, the rest one recipient
+        # each.
+        for fields in part.get_payload()[1:]:
+            action = (fields.get('Action') or '').strip().lower()
+            status = (fields.get('Status') or '').strip()
+            recipient = fields.get('Final-Recipient') or fields.get(
+                'Original-Recipient') or ''
+            if action == 'failed' and status.startswith('5') and (
+                ';' in recipient):
+
+                yield recipient.split(';', 1)[1].strip().strip('<>')
+
+
+def read_mailbox(box):
+    for key in box.iterkeys():
+        message = box.get_message(key)
+        for address in permanent_failures(message):
+            yield address
+
+
+def read_mbox(path):
+    return read_mailbox(mailbox.mbox(path, factory=None, create=False))
+
+
+def read_maildir(path):
+    return read_mailbox(mailbox.Maildir(path, factory=None, create=False))
+
+
+def read_jsonl(path):
+    """
+    One JSON object per line with the address in ``email`` (or
+    ``recipient``). Lines with a ``type`` other than ``bounce``, ``hard`` or
+    ``permanent`` (e.g. soft bounces or complaints) are skipped.
+    """
+    f = open(path)
+    try:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            event = simplejson.loads(line)
+            if event.get('type', 'bounce') not in ('bounce', 'hard',
+                'permanent'):
+
+                continue
+            address = event.get('email') or event.get('recipient')
+            if address:
+                yield address
+    finally:
+        f.close()
+
+
+READERS = {
+    'mbox': read_mbox,
+    'maildir': read_maildir,
+    'jsonl': read_jsonl,
+}
+
+
+def flag_bounced(addresses, chunk_size=500):
+    """
+    Mark UserEmail objects of ``addresses`` as bounced with one UPDATE per
+    ``chunk_size`` addresses, each committed on its own. Returns
+    ``(addresses read, emails flagged)``.
+    """
+    read = flagged = 0
+    chunk = set()
+    for address in addresses:
+        read += 1
+        chunk.add(address)
+        if len(chunk) >= chunk_size:
+            flagged += _flag(chunk)
+            chunk = set()
+    if chunk:
+        flagged += _flag(chunk)
+    return read, flagged
+
+
+def _flag(addresses):
+    return UserEmail.objects.filter(email__in=list(addresses),
+        bounced=False).update(bounced=True)
@@ -0,0 +1,60 @@
+"""
+Short numeric verification codes, kept in the cache rather than the
+database. A code is stored under the email address it verifies together with
+a counter of failed attempts; the database is written to only when a code is
+accepted.
+"""
+import random
+
+from django.core.cache import cache
+from django.utils.hashcompat import md5_constructor
+
+from emailauth.signing import constant_time_compare
+from emailauth.utils import (email_verification_days,
+    verification_code_length, verification_code_attempts)
+
+
+_random = random.SystemRandom()
+
+
+def _key(prefix, email):
+    return 'emailauth-%s-%s' % (prefix,
+        md5_constructor(email.lower().encode('utf-8')).hexdigest())
+
+
+def issue(email):
+    """Create a new code for ``email``, replacing the previous one."""
+    code = ''.join([str(_random.randint(0, 9))
+        for i in range(verification_code_length())])
+    timeout = email_verification_days() * 24 * 60 * 60
+    cache.set(_key('code', email), code, timeout)
+    cache.set(_key('code-attempts', email), 0, timeout)
+    return code
+
+
+def check(email, code):
+    """
+    Return True if ``code`` is the current code of ``email``. Codes are
+    discarded after ``EMAILAUTH_VERIFICATION_CODE_ATTEMPTS`` attempts.
+    """
+    # Count the attempt before comparing, so that concurrent guesses can't
+    # all be compared against the code before any of them is counted.
+    try:
+        attempts = cache.incr(_key('code-attempts', email))
+    except ValueError:
+        attempts = verification_code_attempts() + 1
+    if attempts > verification_code_attempts():
+        discard(email)
+        return False
+
+    expected = cache.get(_key('code', email))
+    if expected is not None and constant_time_compare(expected, code.strip()):
+        return True
+    if attempts == verification_code_attempts():
+        discard(email)
+    return False
+
+
+def discard(email):
+    cache.delete(_key('code', email))
+    cache.delete(_key('code-attempts', email))
@@ -0,0 +1,50 @@
+from emailauth.models import UserEmail
+
+
+class UserEmails(object):
+    """
+    Emails of a user, split into the default one, extra verified ones and
+    unverified ones. They are loaded with a single query on first access.
+    """
+
+    def __init__(self, user):
+        self.user = user
+        self._emails = None
+
+    def _get_emails(self):
+        if self._emails is None:
+            if self.user.is_authenticated():
+                self._emails = list(UserEmail.objects.filter(user=self.user))
+            else:
+                self._emails = []
+        return self._emails
+
+    def all(self):
+        return self._get_emails()
+
+    def default(self):
+        for email in self._get_emails():
+            if email.default:
+                return email
+        return None
+    default = property(default)
+
+    def extra(self):
+        return [email for email in self._get_emails()
+            if not email.default and email.verified]
+    extra = property(extra)
+
+    def unverified(self):
+        return [email for email in self._get_emails()
+            if not email.default and not email.verified]
+    unverified = property(unverified)
+
+
+def get_user_emails(request):
+    if not hasattr(request, '_emailauth_user_emails'):
+        request._emailauth_user_emails = UserEmails(request.user)
+    return request._emailauth_user_emails
+
+
+def emails(request):
+    return {'user_emails': get_user_emails(request)}
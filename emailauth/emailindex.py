@@ -0,0 +1,77 @@
+import logging
+import os
+import threading
+
+from emailauth.bloom import BloomFilter, file_id
+from emailauth.utils import email_index_path
+
+
+logger = logging.getLogger('emailauth.emailindex')
+
+_lock = threading.Lock()
+_index = None
+_index_id = None
+
+
+def normalize(email):
+    # Lower case keys can only add false positives, never false negatives,
+    # whatever collation the database uses for emails.
+    return email.lower()
+
+
+def get_index():
+    """
+    Return the memory-mapped email index of this process or None when the
+    index is disabled, hasn't been built yet or is broken (e.g. truncated).
+    The index is re-mapped when ``buildemailindex`` replaces the file.
+    """
+    global _index, _index_id
+
+    path = email_index_path()
+    if not path:
+        return None
+    try:
+        current_id = file_id(path)
+    except OSError:
+        return None
+
+    if current_id != _index_id:
+        _lock.acquire()
+        try:
+            if current_id != _index_id:
+                if _index is not None:
+                    _index.close()
+                    _index, _index_id = None, None
+                try:
+                    _index = BloomFilter.open(path)
+                except (EnvironmentError, ValueError):
+                    logger.exception('Can not open email index %s', path)
+                # Broken files aren't retried until they are replaced
+                _index_id = current_id
+        finally:
+            _lock.release()
+    return _index
+
+
+def might_be_taken(email):
+    index = get_index()
+    return index is None or normalize(email) in index
+
+
+def add_email(email):
+    index = get_index()
+    if index is not None and normalize(email) not in index:
+        index.add(normalize(email))
+
+
+def build(path, emails, count, capacity_factor, error_rate):
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    index = BloomFilter.create(tmp_path, int(count * capacity_factor),
+        error_rate)
+    try:
+        for email in emails:
+            index.add(normalize(email))
+        index.flush()
+    finally:
+        index.close()
+    os.rename(tmp_path, path)
@@ -0,0 +1,151 @@
+import logging
+import threading
+import time
+import Queue
+
+from django.dispatch import Signal
+from django.utils import simplejson
+
+from emailauth.utils import (event_dispatch_mode, event_queue_size,
+    event_batch_size, event_batch_wait)
+
+
+logger = logging.getLogger('emailauth.events')
+
+# All signals are sent with ``events`` -- a list of dicts, each holding the
+# event name, its time and event specific data (user_id, email_id, email).
+email_verified = Signal(providing_args=['events'])
+email_added = Signal(providing_args=['events'])
+default_email_changed = Signal(providing_args=['events'])
+password_reset = Signal(providing_args=['events'])
+user_expired = Signal(providing_args=['events'])
+
+SIGNALS = {
+    'email_verified': email_verified,
+    'email_added': email_added,
+    'default_email_changed': default_email_changed,
+    'password_reset': password_reset,
+    'user_expired': user_expired,
+}
+
+
+def deliver(events):
+    """Send events to receivers, one batch per signal."""
+    names = []
+    batches = {}
+    for event in events:
+        if event['name'] not in batches:
+            names.append(event['name'])
+            batches[event['name']] = []
+        batches[event['name']].append(event)
+    for name in names:
+        batch = batches[name]
+        for receiver, response in SIGNALS[name].send_robust(sender=None,
+            events=batch):
+
+            if isinstance(response, Exception):
+                logger.error('Receiver %r failed on %s: %r', receiver, name,
+                    response)
+
+
+class QueueDispatcher(object):
+    """
+    Delivers events from a bounded in-process queue in a background thread.
+    """
+
+    def __init__(self, max_size, batch_size, batch_wait):
+        self.queue = Queue.Queue(max_size)
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.delivered = 0
+        self.last_lag = 0.0
+        self.thread = threading.Thread(target=self._run,
+            name='emailauth-events')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def put(self, event):
+        self.queue.put_nowait(event)
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.time() + self.batch_wait
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(True, remaining))
+                except Queue.Empty:
+                    break
+
+            self.last_lag = time.time() - batch[0]['time']
+            try:
+                deliver(batch)
+            except Exception:
+                logger.exception('Failed to deliver emailauth events')
+            self.delivered += len(batch)
+
+    def metrics(self):
+        return {
+            'depth': self.queue.qsize(),
+            'lag': self.last_lag,
+            'delivered': self.delivered,
+        }
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_dispatcher():
+    global _dispatcher
+    if _dispatcher is None:
+        _dispatcher_lock.acquire()
+        try:
+            if _dispatcher is None:
+                _dispatcher = QueueDispatcher(event_queue_size(),
+                    event_batch_size(), event_batch_wait())
+        finally:
+            _dispatcher_lock.release()
+    return _dispatcher
+
+
+def emit(name, **data):
+    """
+    Emit an emailauth event. Depending on ``EMAILAUTH_EVENT_DISPATCH`` the
+    signal is sent right away ('sync'), from a background thread ('queue')
+    or by the ``dispatchemailauthevents`` command ('table').
+    """
+    event = dict(data, name=name, time=time.time())
+    mode = event_dispatch_mode()
+
+    if mode == 'queue':
+        try:
+            get_dispatcher().put(event)
+            return
+        except Queue.Full:
+            logger.warning('emailauth event queue is full, delivering %s '
+                'synchronously', name)
+    elif mode == 'table':
+        from emailauth.models import PendingEvent
+        PendingEvent(name=name, payload=simplejson.dumps(event)).save()
+        return
+
+    deliver([event])
+
+
+def metrics():
+    """
+    Queue depth, lag of the last delivered batch (seconds) and number of
+    delivered events for 'queue' mode; depth and age of the oldest pending
+    event for 'table' mode.
+    """
+    mode = event_dispatch_mode()
+    if mode == 'queue':
+        return get_dispatcher().metrics()
+    elif mode == 'table':
+        from emailauth.models import PendingEvent
+        return PendingEvent.objects.metrics()
+    return {'depth': 0, 'lag': 0.0}
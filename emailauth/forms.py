@@ -4,7 +4,8 @@ from django.utils.translation import ugettext_lazy as _
 
 from django.contrib.auth.models import User
 
-from emailauth.models import UserEmail
+from emailauth.models import UserEmail, UserEmailSummary
+from emailauth import routers
 
 attrs_dict = {}
 
@@ -66,11 +67,8 @@ class RegistrationForm(forms.Form):
     def clean_email(self):
         email = self.cleaned_data['email']
 
-        try:
-            user = UserEmail.objects.get(email=email)
+        if UserEmail.objects.email_taken(email):
             raise forms.ValidationError(_(u'This email is already taken.'))
-        except UserEmail.DoesNotExist:
-            pass
         return email
         
 
@@ -101,10 +99,15 @@ class RegistrationForm(forms.Form):
 class PasswordResetRequestForm(forms.Form):
     email = forms.EmailField(label=_(u'your email address'))
 
+    # The UserEmail (with its user) found by validation
+    user_email = None
+
     def clean_email(self):
         data = self.cleaned_data
+        routers.check_email(data['email'])
         try:
-            user_email = UserEmail.objects.get(email=data['email'])
+            self.user_email = UserEmail.objects.select_related('user').get(
+                email=data['email'])
             return data['email']
         except UserEmail.DoesNotExist:
             raise forms.ValidationError(_(u'Unknown email'))
@@ -125,11 +128,8 @@ class AddEmailForm(forms.Form):
     def clean_email(self):
         email = self.cleaned_data['email']
 
-        try:
-            user = UserEmail.objects.get(email=email)
+        if UserEmail.objects.email_taken(email):
             raise forms.ValidationError(_(u'This email is already taken.'))
-        except UserEmail.DoesNotExist:
-            pass
         return email
 
 
@@ -141,8 +141,8 @@ class DeleteEmailForm(forms.Form):
         super(DeleteEmailForm, self).__init__(*args, **kwds)
 
     def clean(self):
-        count = UserEmail.objects.filter(user=self.user).count()
-        if UserEmail.objects.filter(user=self.user, verified=True).count() < 2:
+        summary = UserEmailSummary.objects.get_for_user(self.user.id)
+        if summary.verified_count < 2:
             raise forms.ValidationError(_('You can not delete your last verified '
                 'email.'))
         return self.cleaned_data
@@ -0,0 +1,156 @@
+import cookielib
+import errno
+import os
+import re
+import socket
+import time
+import urllib
+import urllib2
+
+
+VERIFICATION_URL_RE = re.compile(r'http://\S*?(/verify/\S+/)')
+MESSAGE_SEPARATOR = '-' * 79
+
+STEPS = ('register', 'verify', 'login', 'account')
+
+
+class LoadTestError(Exception):
+    def __init__(self, category):
+        Exception.__init__(self, category)
+        self.category = category
+
+
+class MailBox(object):
+    """
+    Finds verification links in messages written by Django's file based
+    email backend.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.seen = set()
+        self.links = {}
+
+    def scan(self):
+        try:
+            names = os.listdir(self.path)
+        except OSError as e:
+            # The backend creates the directory with the first message
+            if e.errno != errno.ENOENT:
+                raise
+            names = []
+        for name in sorted(names):
+            if name in self.seen:
+                continue
+            self.seen.add(name)
+            content = open(os.path.join(self.path, name)).read()
+            for message in content.split(MESSAGE_SEPARATOR):
+                match = VERIFICATION_URL_RE.search(message)
+                to = re.search(r'^To: (.*)$', message, re.MULTILINE)
+                if match and to:
+                    self.links[to.group(1).strip()] = match.group(1)
+
+    def get_link(self, email, timeout):
+        deadline = time.time() + timeout
+        while True:
+            self.scan()
+            if email in self.links:
+                return self.links.pop(email)
+            if time.time() > deadline:
+                raise LoadTestError('no verification email')
+            time.sleep(0.05)
+
+
+class Browser(object):
+    def __init__(self, base_url, timeout):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.opener = urllib2.build_opener(
+            urllib2.HTTPCookieProcessor(cookielib.CookieJar()))
+
+    def request(self, path, data=None):
+        if data is not None:
+            data = urllib.urlencode(data)
+        try:
+            response = self.opener.open(self.base_url + path, data,
+                self.timeout)
+            response.read()
+            return response.geturl()
+        except urllib2.HTTPError as e:
+            raise LoadTestError('HTTP %d' % e.code)
+        except urllib2.URLError as e:
+            if isinstance(e.reason, socket.timeout):
+                raise LoadTestError('timeout')
+            raise LoadTestError('connection error')
+        except socket.timeout:
+            raise LoadTestError('timeout')
+
+    def expect(self, url, path):
+        if not url.endswith(path) and ('%s?' % path) not in url:
+            raise LoadTestError('unexpected page')
+
+
+def run_cycle(browser_factory, mailbox, email, mail_timeout, latencies):
+    def timed(step, func):
+        started = time.time()
+        result = func()
+        latencies[step].append(time.time() - started)
+        return result
+
+    browser = browser_factory()
+    url = timed('register', lambda: browser.request('/register/', {
+        'email': email,
+        'first_name': 'Load',
+        'password1': 'password',
+        'password2': 'password',
+    }))
+    if '/register/continue/' not in url:
+        raise LoadTestError('registration rejected')
+
+    link = mailbox.get_link(email, mail_timeout)
+    browser.expect(timed('verify', lambda: browser.request(link)), '/account/')
+
+    browser = browser_factory()
+    browser.request('/login/')
+    url = timed('login', lambda: browser.request('/login/', {
+        'email': email,
+        'password': 'password',
+    }))
+    browser.expect(url, '/account/')
+
+    browser.expect(timed('account', lambda: browser.request('/account/')),
+        '/account/')
+
+
+def run_worker(args):
+    """
+    Run ``cycles`` register -> verify -> login -> account cycles. Returns a
+    dict with per-step latencies, error counts and completed cycles.
+    """
+    (worker_id, cycles, base_url, mail_path, timeout, mail_timeout,
+        run_id) = args
+
+    mailbox = MailBox(mail_path)
+    latencies = dict((step, []) for step in STEPS)
+    errors = {}
+    completed = 0
+    browser_factory = lambda: Browser(base_url, timeout)
+
+    for i in range(cycles):
+        email = 'load-%s-%d-%d@example.com' % (run_id, worker_id, i)
+        try:
+            run_cycle(browser_factory, mailbox, email, mail_timeout,
+                latencies)
+            completed += 1
+        except LoadTestError as e:
+            errors[e.category] = errors.get(e.category, 0) + 1
+
+    return {'latencies': latencies, 'errors': errors, 'completed': completed}
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
@@ -0,0 +1,218 @@
+import logging
+import threading
+import time
+import Queue
+from collections import deque
+
+import django.core.mail
+from django.conf import settings
+
+from emailauth.utils import (mail_workers, mail_queue_size,
+    mail_domain_limits, mail_domain_rate, mail_domain_concurrency)
+from emailauth.profiling import timer
+
+
+logger = logging.getLogger('emailauth.mail')
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def email_domain(email):
+    return email.rsplit('@', 1)[-1].lower()
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.capacity = max(burst, 1)
+        self.tokens = self.capacity
+        self.updated = time.time()
+
+    def delay(self, now):
+        """Seconds until a token is available."""
+        self.tokens = min(self.capacity,
+            self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class DomainScheduler(object):
+    """
+    Sends queued messages from a pool of threads, interleaving recipient
+    domains round robin. Each domain has its own rate limit (messages per
+    second, None for no limit) and a cap on messages being sent to it at
+    the same time, so a burst to one big provider doesn't hold back mail to
+    everyone else and doesn't get us throttled.
+    """
+
+    def __init__(self, send, workers, max_pending, limits=None,
+        default_rate=None, default_concurrency=2):
+
+        self.send = send
+        self.workers = workers
+        self.max_pending = max_pending
+        self.limits = limits or {}
+        self.default_rate = default_rate
+        self.default_concurrency = default_concurrency
+
+        self.condition = threading.Condition()
+        self.queues = {}
+        self.domains = deque()
+        self.in_flight = {}
+        self.buckets = {}
+        self.pending = 0
+        self.sending = 0
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker,
+                name='emailauth-mail-%d' % i)
+            thread.setDaemon(True)
+            thread.start()
+
+    def _limit(self, domain, name, default):
+        return self.limits.get(domain, {}).get(name, default)
+
+    def put(self, domain, message):
+        self.condition.acquire()
+        try:
+            if self.pending >= self.max_pending:
+                raise Queue.Full()
+            if domain not in self.queues:
+                self.queues[domain] = deque()
+                self.domains.append(domain)
+                rate = self._limit(domain, 'rate', self.default_rate)
+                if rate and domain not in self.buckets:
+                    self.buckets[domain] = TokenBucket(rate,
+                        self._limit(domain, 'burst', 1))
+            self.queues[domain].append(message)
+            self.pending += 1
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+    def _next(self):
+        """
+        Pick the next message to send. Returns ``(domain, message, None)`` or
+        ``(None, None, wait)`` where ``wait`` is the number of seconds until a
+        rate limited domain may be tried again (None if there's nothing to
+        wait for).
+        """
+        now = time.time()
+        wait = None
+        for i in range(len(self.domains)):
+            domain = self.domains[0]
+            self.domains.rotate(-1)
+
+            concurrency = self._limit(domain, 'concurrency',
+                self.default_concurrency)
+            if concurrency and self.in_flight.get(domain, 0) >= concurrency:
+                continue
+
+            bucket = self.buckets.get(domain)
+            if bucket is not None:
+                delay = bucket.delay(now)
+                if delay > 0:
+                    if wait is None or delay < wait:
+                        wait = delay
+                    continue
+                bucket.take()
+
+            queue = self.queues[domain]
+            message = queue.popleft()
+            if not queue:
+                del self.queues[domain]
+                self.domains.remove(domain)
+            return domain, message, None
+        return None, None, wait
+
+    def _worker(self):
+        while True:
+            self.condition.acquire()
+            try:
+                while True:
+                    domain, message, wait = self._next()
+                    if domain is not None:
+                        break
+                    self.condition.wait(wait)
+                self.pending -= 1
+                self.sending += 1
+                self.in_flight[domain] = self.in_flight.get(domain, 0) + 1
+            finally:
+                self.condition.release()
+
+            try:
+                self.send(*message)
+            except Exception:
+                logger.exception('Failed to send email to %s', domain)
+
+            self.condition.acquire()
+            try:
+                self.in_flight[domain] -= 1
+                if not self.in_flight[domain]:
+                    del self.in_flight[domain]
+                self.sending -= 1
+                self.condition.notifyAll()
+            finally:
+                self.condition.release()
+
+    def wait_idle(self, timeout=None):
+        """Wait until all queued messages are sent. Returns True if they are."""
+        deadline = timeout is not None and time.time() + timeout
+        self.condition.acquire()
+        try:
+            while self.pending or self.sending:
+                if deadline:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self.condition.wait(remaining)
+                else:
+                    self.condition.wait()
+            return True
+        finally:
+            self.condition.release()
+
+
+def get_scheduler():
+    global _scheduler
+    if _scheduler is None:
+        _scheduler_lock.acquire()
+        try:
+            if _scheduler is None:
+                scheduler = DomainScheduler(django.core.mail.send_mail,
+                    mail_workers(), mail_queue_size(), mail_domain_limits(),
+                    mail_domain_rate(), mail_domain_concurrency())
+                scheduler.start()
+                _scheduler = scheduler
+        finally:
+            _scheduler_lock.release()
+    return _scheduler
+
+
+@timer('mail_time')
+def send_mail(subject, message, recipient_list):
+    """
+    Send an email from ``DEFAULT_FROM_EMAIL``.
+
+    With ``EMAILAUTH_MAIL_WORKERS`` set to a positive number the message is
+    handed over to a DomainScheduler so that the request doesn't wait for
+    the SMTP server. When the queue is full the message is sent
+    synchronously.
+    """
+    args = (subject, message, settings.DEFAULT_FROM_EMAIL, recipient_list)
+
+    if mail_workers() > 0:
+        try:
+            get_scheduler().put(email_domain(recipient_list[0]), args)
+            return
+        except Queue.Full:
+            pass
+
+    django.core.mail.send_mail(*args)
@@ -0,0 +1,39 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db.models import Max
+
+from emailauth import emailindex
+from emailauth.models import UserEmail
+from emailauth.utils import email_index_path
+
+
+class Command(NoArgsCommand):
+    help = ("Build the Bloom filter index of taken emails used by "
+        "registration forms and the email availability view")
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--capacity-factor', dest='capacity_factor', type='float',
+            default=2.0, help='Size the index for this many times the '
+                'current number of emails'),
+        make_option('--error-rate', dest='error_rate', type='float',
+            default=0.01, help='Target false positive rate'),
+    )
+
+    def handle_noargs(self, **options):
+        path = email_index_path()
+        if not path:
+            raise CommandError('EMAILAUTH_EMAIL_INDEX is not set')
+
+        last_id = UserEmail.objects.aggregate(last_id=Max('id'))['last_id'] or 0
+        existing = UserEmail.objects.filter(id__lte=last_id)
+        emailindex.build(path,
+            existing.values_list('email', flat=True).iterator(),
+            existing.count(), options['capacity_factor'],
+            options['error_rate'])
+
+        # Emails created while the index was being built
+        for email in UserEmail.objects.filter(id__gt=last_id).values_list(
+            'email', flat=True):
+
+            emailindex.add_email(email)
@@ -1,10 +1,13 @@
 from django.core.management.base import NoArgsCommand
 
-from emailauth.models import UserEmail
+from emailauth.models import UserEmail, PasswordResetToken, UserSession
 
 
 class Command(NoArgsCommand):
-    help = "Delete expired UserEmail objects from the database"
+    help = ("Delete expired UserEmail, PasswordResetToken and UserSession "
+        "objects from the database")
 
     def handle_noargs(self, **options):
         UserEmail.objects.delete_expired()
+        PasswordResetToken.objects.delete_expired()
+        UserSession.objects.delete_expired()
@@ -0,0 +1,43 @@
+import sys
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.utils import simplejson
+
+from emailauth.models import PendingEvent
+from emailauth.utils import event_batch_size
+from emailauth import events
+
+
+class Command(NoArgsCommand):
+    help = "Deliver pending emailauth events to signal receivers in batches"
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int',
+            default=None, help='Number of events delivered at once'),
+        make_option('--poll', dest='poll', type='float', default=None,
+            help='Keep running, checking for new events every POLL seconds'),
+    )
+
+    def handle_noargs(self, **options):
+        batch_size = options['batch_size'] or event_batch_size()
+        poll = options['poll']
+        verbosity = int(options.get('verbosity', 1))
+
+        delivered = 0
+        while True:
+            pending = list(PendingEvent.objects.order_by('id')[:batch_size])
+            if pending:
+                events.deliver([simplejson.loads(event.payload)
+                    for event in pending])
+                PendingEvent.objects.filter(
+                    id__in=[event.id for event in pending]).delete()
+                delivered += len(pending)
+            elif poll:
+                time.sleep(poll)
+            else:
+                break
+
+        if verbosity > 0:
+            sys.stdout.write('Delivered %d events\n' % delivered)
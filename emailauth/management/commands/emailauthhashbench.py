@@ -0,0 +1,156 @@
+import multiprocessing
+import re
+import sys
+import time
+from optparse import make_option
+
+from django.contrib.auth.models import (User, get_hexdigest, check_password,
+    UNUSABLE_PASSWORD)
+from django.core.management.base import NoArgsCommand
+
+from emailauth.loadtest import percentile
+
+
+ALGORITHMS = ('sha1', 'md5', 'crypt')
+
+# What User.set_password() uses; check_password() upgrades old unsalted md5
+# hashes (without '$') to it on successful login.
+PREFERRED_ALGORITHM = 'sha1'
+
+UNSALTED_MD5_RE = re.compile(r'^[0-9a-f]{32}$')
+
+
+def hash_algorithm(password):
+    """
+    Name the algorithm of a stored password: the prefix of salted hashes,
+    'unsalted md5' for the old hashes check_password() upgrades, 'unusable'
+    for set_unusable_password() and 'unknown' for anything else.
+    """
+    if not password or password == UNUSABLE_PASSWORD:
+        return 'unusable'
+    if '$' in password:
+        return password.split('$', 1)[0]
+    if UNSALTED_MD5_RE.match(password):
+        return 'unsalted md5'
+    return 'unknown'
+
+
+def make_hash(algorithm, password='password', salt='abcde'):
+    return '%s$%s$%s' % (algorithm, salt,
+        get_hexdigest(algorithm, salt, password))
+
+
+def time_checks(args):
+    encoded, iterations = args
+    timings = []
+    for i in range(iterations):
+        started = time.time()
+        check_password('password', encoded)
+        timings.append(time.time() - started)
+    return timings
+
+
+def available_algorithms():
+    result = []
+    for algorithm in ALGORITHMS:
+        try:
+            make_hash(algorithm)
+        except (ValueError, TypeError):
+            continue
+        result.append(algorithm)
+    return result
+
+
+class Command(NoArgsCommand):
+    help = ("Benchmark password hash checks on this host with different "
+        "numbers of processes, recommend login concurrency for a target p99 "
+        "latency and count stored hashes that will be upgraded on login")
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--target-ms', dest='target_ms', type='float',
+            default=100, help='Target p99 password check latency in ms'),
+        make_option('--iterations', dest='iterations', type='int',
+            default=2000, help='Checks per process'),
+        make_option('--max-processes', dest='max_processes', type='int',
+            default=multiprocessing.cpu_count() * 2,
+            help='Largest number of concurrent processes to try'),
+        make_option('--chunk-size', dest='chunk_size', type='int',
+            default=5000, help='Users read per query when scanning hashes'),
+        make_option('--skip-scan', dest='skip_scan', action='store_true',
+            default=False, help="Don't scan stored password hashes"),
+    )
+
+    def handle_noargs(self, **options):
+        out = sys.stdout
+        target = options['target_ms'] / 1000.0
+
+        out.write('%d CPUs\n' % multiprocessing.cpu_count())
+        out.write('%-8s %9s %9s %9s %12s\n' % ('hasher', 'processes',
+            'p50 ms', 'p99 ms', 'checks/s'))
+
+        recommendations = {}
+        processes = 1
+        while processes <= options['max_processes']:
+            for algorithm in available_algorithms():
+                p50, p99, rate = self.benchmark(make_hash(algorithm),
+                    processes, options['iterations'])
+                out.write('%-8s %9d %9.3f %9.3f %12.0f\n' % (algorithm,
+                    processes, p50 * 1000, p99 * 1000, rate))
+                if p99 <= target:
+                    recommendations[algorithm] = (processes, rate)
+            processes *= 2
+
+        out.write('\n')
+        for algorithm in available_algorithms():
+            if algorithm in recommendations:
+                processes, rate = recommendations[algorithm]
+                out.write('%s: up to %d concurrent logins keep p99 within '
+                    '%.0f ms (%.0f checks/s)\n' % (algorithm, processes,
+                    options['target_ms'], rate))
+            else:
+                out.write('%s: p99 exceeds %.0f ms even with one process\n' %
+                    (algorithm, options['target_ms']))
+        out.write('Django uses %s for new passwords, its cost is fixed.\n' %
+            PREFERRED_ALGORITHM)
+
+        if not options['skip_scan']:
+            self.scan(options['chunk_size'])
+
+    def benchmark(self, encoded, processes, iterations):
+        pool = multiprocessing.Pool(processes)
+        try:
+            started = time.time()
+            results = pool.map(time_checks, [(encoded, iterations)] *
+                processes)
+            elapsed = time.time() - started
+        finally:
+            pool.close()
+            pool.join()
+
+        timings = []
+        for result in results:
+            timings.extend(result)
+        return (percentile(timings, 0.5), percentile(timings, 0.99),
+            len(timings) / elapsed)
+
+    def scan(self, chunk_size):
+        # Only the algorithm prefix is needed, users are read in id ranges to
+        # keep memory use flat on big tables.
+        counts = {}
+        last_id = 0
+        while True:
+            rows = list(User.objects.filter(id__gt=last_id).order_by(
+                'id').values_list('id', 'password')[:chunk_size])
+            if not rows:
+                break
+            for user_id, password in rows:
+                algorithm = hash_algorithm(password)
+                counts[algorithm] = counts.get(algorithm, 0) + 1
+            last_id = rows[-1][0]
+
+        out = sys.stdout
+        out.write('\nStored password hashes:\n')
+        for algorithm, count in sorted(counts.items()):
+            out.write('    %-14s %d\n' % (algorithm, count))
+        out.write('Will be upgraded to %s on next login: %d\n' %
+            (PREFERRED_ALGORITHM, counts.get('unsalted md5', 0)))
@@ -0,0 +1,106 @@
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+import urllib2
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import NoArgsCommand, CommandError
+
+from emailauth.loadtest import STEPS, run_worker, percentile
+
+
+class Command(NoArgsCommand):
+    help = ("Drive register -> verify -> login -> account cycles against a "
+        "server from a pool of worker processes and report throughput, "
+        "latencies and errors. The server must use the file based email "
+        "backend with the same EMAIL_FILE_PATH.")
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--url', dest='url', default='http://127.0.0.1:8000',
+            help='Base URL of the server'),
+        make_option('--spawn', dest='spawn', action='store_true',
+            default=False, help='Start runserver on --url for the test'),
+        make_option('--workers', dest='workers', type='int', default=4,
+            help='Number of worker processes'),
+        make_option('--cycles', dest='cycles', type='int', default=25,
+            help='Number of cycles per worker'),
+        make_option('--timeout', dest='timeout', type='float', default=30,
+            help='HTTP request timeout in seconds'),
+        make_option('--mail-timeout', dest='mail_timeout', type='float',
+            default=30, help='Seconds to wait for a verification email'),
+    )
+
+    def handle_noargs(self, **options):
+        if settings.EMAIL_BACKEND != ('django.core.mail.backends.filebased.'
+            'EmailBackend'):
+
+            raise CommandError('Load test needs the file based email backend')
+        mail_path = settings.EMAIL_FILE_PATH
+        base_url = options['url']
+
+        server = None
+        if options['spawn']:
+            address = base_url.split('://', 1)[-1].rstrip('/')
+            server = subprocess.Popen([sys.executable, sys.argv[0],
+                'runserver', address, '--noreload',
+                '--settings=%s' % os.environ['DJANGO_SETTINGS_MODULE']])
+            self.wait_for_server(base_url)
+
+        try:
+            run_id = '%x' % int(time.time())
+            tasks = [(worker_id, options['cycles'], base_url, mail_path,
+                options['timeout'], options['mail_timeout'], run_id)
+                for worker_id in range(options['workers'])]
+
+            pool = multiprocessing.Pool(options['workers'])
+            started = time.time()
+            results = pool.map(run_worker, tasks)
+            elapsed = time.time() - started
+            pool.close()
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+
+        self.report(results, elapsed)
+
+    def wait_for_server(self, base_url, timeout=30):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try:
+                urllib2.urlopen(base_url + '/login/', timeout=1).read()
+                return
+            except Exception:
+                time.sleep(0.2)
+        raise CommandError('Server at %s did not start' % base_url)
+
+    def report(self, results, elapsed):
+        completed = sum(result['completed'] for result in results)
+        errors = {}
+        for result in results:
+            for category, count in result['errors'].items():
+                errors[category] = errors.get(category, 0) + count
+
+        out = sys.stdout
+        out.write('Completed cycles: %d in %.1f s (%.2f cycles/s)\n' %
+            (completed, elapsed, completed / elapsed))
+
+        out.write('%-10s %8s %8s %8s %8s %8s\n' %
+            ('step', 'count', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms'))
+        for step in STEPS:
+            latencies = []
+            for result in results:
+                latencies.extend(result['latencies'][step])
+            if not latencies:
+                continue
+            out.write('%-10s %8d %8.1f %8.1f %8.1f %8.1f\n' % ((step,
+                len(latencies)) + tuple(1000 * percentile(latencies, fraction)
+                for fraction in (0.5, 0.9, 0.99, 1.0))))
+
+        if errors:
+            out.write('Errors:\n')
+            for category, count in sorted(errors.items()):
+                out.write('    %s: %d\n' % (category, count))
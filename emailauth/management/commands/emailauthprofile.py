@@ -0,0 +1,206 @@
+import cProfile
+import pstats
+import re
+import sys
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.core import mail
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.client import Client
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from emailauth.loadtest import percentile
+
+
+VERIFICATION_URL_RE = re.compile(r'.*http://.*?(/\S*/)',
+    re.UNICODE | re.MULTILINE)
+VERIFICATION_CODE_RE = re.compile(r'code: (\d+)')
+
+
+class Flow(object):
+    """
+    A user action to profile. ``prepare`` runs before every iteration and
+    isn't profiled, ``run`` is profiled.
+    """
+
+    def __init__(self, iteration):
+        self.iteration = iteration
+        self.client = Client()
+        self.email = 'user%d@example.com' % iteration
+
+    def register(self):
+        return self.client.post('/register/', {
+            'email': self.email,
+            'first_name': 'John',
+            'password1': 'password',
+            'password2': 'password',
+        })
+
+    def verification_path(self):
+        return VERIFICATION_URL_RE.search(mail.outbox[-1].body).groups()[0]
+
+    def verify(self):
+        return self.client.get(self.verification_path())
+
+    def login(self):
+        return self.client.post('/login/', {
+            'email': self.email,
+            'password': 'password',
+        })
+
+    def prepare(self):
+        pass
+
+    def run(self):
+        raise NotImplementedError()
+
+
+class RegisterFlow(Flow):
+    def run(self):
+        self.register()
+
+
+class VerifyFlow(Flow):
+    def prepare(self):
+        self.register()
+
+    def run(self):
+        self.verify()
+
+
+class VerifyCodeFlow(Flow):
+    def prepare(self):
+        settings.EMAILAUTH_VERIFICATION_CODES = True
+        self.register()
+
+    def run(self):
+        body = mail.outbox[-1].body
+        self.client.post('/api/verify/code/', {
+            'email': self.email,
+            'code': VERIFICATION_CODE_RE.search(body).groups()[0],
+        })
+
+
+class LoginFlow(Flow):
+    def prepare(self):
+        self.register()
+        self.verify()
+        self.client = Client()
+
+    def run(self):
+        self.login()
+
+
+class AccountFlow(Flow):
+    def prepare(self):
+        self.register()
+        self.verify()
+
+    def run(self):
+        self.client.get('/account/')
+
+
+# JSON API versions of the flows above, to compare them with the HTML views
+
+class ApiRegisterFlow(Flow):
+    def run(self):
+        self.client.post('/api/register/', {
+            'email': self.email,
+            'first_name': 'John',
+            'password1': 'password',
+            'password2': 'password',
+        })
+
+
+class ApiVerifyFlow(Flow):
+    def prepare(self):
+        self.register()
+
+    def run(self):
+        self.client.post('/api/verify/', {
+            'verification_key': self.verification_path().split('/')[-2],
+        })
+
+
+class ApiLoginFlow(LoginFlow):
+    def run(self):
+        self.client.post('/api/login/', {
+            'email': self.email,
+            'password': 'password',
+        })
+
+
+FLOWS = {
+    'register': RegisterFlow,
+    'verify': VerifyFlow,
+    'verify_code': VerifyCodeFlow,
+    'login': LoginFlow,
+    'account': AccountFlow,
+    'api_register': ApiRegisterFlow,
+    'api_verify': ApiVerifyFlow,
+    'api_login': ApiLoginFlow,
+}
+
+
+class Command(BaseCommand):
+    help = ("Run an emailauth flow (%s) under cProfile against a test "
+        "database and print the hotspots" % ', '.join(sorted(FLOWS)))
+    args = '<flow>'
+
+    option_list = BaseCommand.option_list + (
+        make_option('-n', '--iterations', dest='iterations', type='int',
+            default=20, help='Number of times the flow is run'),
+        make_option('--limit', dest='limit', type='int', default=25,
+            help='Number of functions to print'),
+        make_option('--sort', dest='sort', default='cumulative',
+            help='pstats sort key'),
+        make_option('--timing', dest='timing', action='store_true',
+            default=False, help='Print per-call latency instead of running '
+            'the flow under cProfile'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1 or args[0] not in FLOWS:
+            raise CommandError('Choose a flow to profile: %s' %
+                ', '.join(sorted(FLOWS)))
+        flow_class = FLOWS[args[0]]
+        verbosity = int(options.get('verbosity', 1))
+
+        setup_test_environment()
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=verbosity)
+        try:
+            if options['timing']:
+                self.time_flow(flow_class, options['iterations'])
+            else:
+                self.profile_flow(flow_class, options['iterations'],
+                    options['sort'], options['limit'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity)
+            teardown_test_environment()
+
+    def profile_flow(self, flow_class, iterations, sort, limit):
+        profile = cProfile.Profile()
+        for i in range(iterations):
+            flow = flow_class(i)
+            flow.prepare()
+            profile.runcall(flow.run)
+
+        stats = pstats.Stats(profile)
+        stats.strip_dirs().sort_stats(sort).print_stats(limit)
+
+    def time_flow(self, flow_class, iterations):
+        latencies = []
+        for i in range(iterations):
+            flow = flow_class(i)
+            flow.prepare()
+            started = time.time()
+            flow.run()
+            latencies.append(time.time() - started)
+
+        sys.stdout.write('%d calls: p50 %.1f ms, p90 %.1f ms, max %.1f ms\n' %
+            ((len(latencies),) + tuple(1000 * percentile(latencies, fraction)
+            for fraction in (0.5, 0.9, 1.0))))
@@ -0,0 +1,25 @@
+import sys
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from emailauth.stats import COUNTERS, get_stats
+
+
+class Command(NoArgsCommand):
+    help = "Print cached emailauth statistics"
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--refresh', dest='refresh', action='store_true',
+            default=False, help='Recompute statistics instead of using the '
+                'cached ones'),
+    )
+
+    def handle_noargs(self, **options):
+        stats = get_stats(refresh=options['refresh'])
+        for name in COUNTERS:
+            sys.stdout.write('%-16s %d\n' % (name, stats[name]))
+        sys.stdout.write('%-16s %s\n' % ('computed_at',
+            time.strftime('%Y-%m-%d %H:%M:%S',
+            time.localtime(stats['computed_at']))))
@@ -0,0 +1,44 @@
+import os
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from emailauth import bounces
+
+
+class Command(BaseCommand):
+    help = ("Flag emails that hard-bounced, reading DSNs from an mbox or "
+        "a maildir or bounce events from a JSON lines file")
+    args = '<path>'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', default=None,
+            help='mbox, maildir or jsonl (guessed from the path by default)'),
+        make_option('--chunk-size', dest='chunk_size', type='int',
+            default=500, help='Number of addresses flagged per UPDATE'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Give a path to read bounces from')
+        path = args[0]
+        verbosity = int(options.get('verbosity', 1))
+
+        format = options['format']
+        if format is None:
+            if os.path.isdir(path):
+                format = 'maildir'
+            elif path.endswith('.jsonl') or path.endswith('.json'):
+                format = 'jsonl'
+            else:
+                format = 'mbox'
+        if format not in bounces.READERS:
+            raise CommandError('Unknown format: %s' % format)
+
+        read, flagged = bounces.flag_bounced(bounces.READERS[format](path),
+            options['chunk_size'])
+
+        if verbosity > 0:
+            sys.stdout.write('Read %d bounces, flagged %d emails\n' %
+                (read, flagged))
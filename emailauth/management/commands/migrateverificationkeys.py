@@ -0,0 +1,43 @@
+import sys
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from emailauth.models import UserEmail
+
+
+# The value emailauth used to store in verification_key of verified emails
+LEGACY_VERIFIED = 'ALREADY_VERIFIED'
+
+
+class Command(NoArgsCommand):
+    help = ("Replace the legacy '%s' verification keys with NULL" %
+        LEGACY_VERIFIED)
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--chunk-size', dest='chunk_size', type='int',
+            default=1000, help='Number of rows updated per transaction'),
+    )
+
+    def handle_noargs(self, **options):
+        chunk_size = options['chunk_size']
+        verbosity = int(options.get('verbosity', 1))
+
+        last_id = 0
+        total = 0
+        while True:
+            ids = list(UserEmail.objects.filter(id__gt=last_id,
+                verification_key=LEGACY_VERIFIED).order_by('id').values_list(
+                'id', flat=True)[:chunk_size])
+            if not ids:
+                break
+
+            UserEmail.objects.filter(id__in=ids).update(verification_key=None)
+            transaction.commit_unless_managed()
+
+            last_id = ids[-1]
+            total += len(ids)
+
+        if verbosity > 0:
+            sys.stdout.write('Updated %d emails\n' % total)
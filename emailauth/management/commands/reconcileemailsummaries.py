@@ -0,0 +1,33 @@
+import sys
+from optparse import make_option
+
+from django.contrib.auth.models import User
+from django.core.management.base import NoArgsCommand
+
+from emailauth.models import UserEmailSummary
+
+
+class Command(NoArgsCommand):
+    help = "Recompute per-user email summaries and repair the drifted ones"
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--chunk-size', dest='chunk_size', type='int',
+            default=1000, help='Number of users processed per transaction'),
+    )
+
+    def handle_noargs(self, **options):
+        chunk_size = options['chunk_size']
+        verbosity = int(options.get('verbosity', 1))
+
+        last_id = 0
+        repaired = 0
+        while True:
+            user_ids = list(User.objects.filter(id__gt=last_id).order_by(
+                'id').values_list('id', flat=True)[:chunk_size])
+            if not user_ids:
+                break
+            repaired += UserEmailSummary.objects.reconcile(user_ids)
+            last_id = user_ids[-1]
+
+        if verbosity > 0:
+            sys.stdout.write('Repaired %d summaries\n' % repaired)
@@ -0,0 +1,79 @@
+import time
+
+from django.contrib.auth import SESSION_KEY
+from django.db import connection
+
+from emailauth import routers, profiling
+from emailauth.utils import replica_pin_seconds
+
+
+class ReplicaPinningMiddleware(object):
+    """
+    Keep sessions that have just written emailauth data, and users whose
+    emails were written, on the primary database. Must be placed after
+    SessionMiddleware.
+    """
+
+    session_key = '_emailauth_primary_until'
+
+    def process_request(self, request):
+        routers.reset()
+        pinned_until = request.session.get(self.session_key)
+        if pinned_until is not None and pinned_until > time.time():
+            routers.pin_to_primary()
+        user_id = request.session.get(SESSION_KEY)
+        if user_id is not None:
+            routers.check_user(user_id)
+
+    def process_response(self, request, response):
+        if routers.has_written() and hasattr(request, 'session'):
+            request.session[self.session_key] = (time.time() +
+                replica_pin_seconds())
+        routers.pin_written()
+        routers.reset()
+        return response
+
+
+class ProfilingMiddleware(object):
+    """
+    Record query count and time, template render time and mail send time
+    of requests handled by emailauth views, see emailauth.profiling.record.
+    """
+
+    view_modules = ('emailauth.views', 'emailauth.api')
+
+    def __init__(self):
+        profiling.install()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if getattr(view_func, '__module__', None) not in self.view_modules:
+            return None
+
+        # API views have the names of their HTML counterparts
+        view_name = view_func.__name__
+        if view_func.__module__ == 'emailauth.api':
+            view_name = 'api.' + view_name
+        request._emailauth_profile = (view_name, time.time(),
+            connection.__dict__.get('cursor'))
+        cursor = connection.cursor
+        connection.cursor = lambda: profiling.ProfilingCursor(cursor())
+        profiling.start()
+        return None
+
+    def process_response(self, request, response):
+        profile = getattr(request, '_emailauth_profile', None)
+        if profile is None:
+            return response
+
+        view_name, started, original_cursor = profile
+        stats = profiling.stop()
+        if original_cursor is None:
+            del connection.cursor
+        else:
+            connection.cursor = original_cursor
+        del request._emailauth_profile
+
+        if stats is not None:
+            stats['total_time'] = time.time() - started
+            profiling.record(view_name, stats)
+        return response
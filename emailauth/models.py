@@ -1,9 +1,10 @@
 import datetime
 import random
 
-import django.core.mail
-
-from django.db import models
+from django.db import (models, transaction, router, connections,
+    IntegrityError)
+from django.db.models import Count, F
+from django.db.models.signals import post_save, post_delete
 from django.contrib.auth.models import User
 from django.contrib.sites.models import Site
 
@@ -11,11 +12,14 @@ from django.template.loader import render_to_string
 
 from django.utils.hashcompat import sha_constructor
 from django.utils.translation import ugettext_lazy as _
-import django.core.mail
 
 from django.conf import settings
 
-from emailauth.utils import email_verification_days, use_automaintenance
+from emailauth.utils import (email_verification_days, use_automaintenance,
+    use_single_email, password_reset_days, use_verification_codes,
+    replica_databases)
+from emailauth.mail import send_mail
+from emailauth import emailindex, stats, events, codes, routers
 
 class UserEmailManager(models.Manager):
     def make_random_key(self, email):
@@ -27,34 +31,154 @@ class UserEmailManager(models.Manager):
         if use_automaintenance():
             self.delete_expired()
         
-        email_obj = UserEmail(email=email, user=user, default=user is None,
-            verification_key=self.make_random_key(email))
+        email_obj = UserEmail(email=email, user=user, default=user is None)
+        email_obj.make_new_key()
         return email_obj
 
     def verify(self, verification_key):
+        if not verification_key:
+            return None
+        try:
+            email = self.select_related('user').get(
+                verification_key=verification_key)
+        except self.model.DoesNotExist:
+            # Only the key is known here, so no pin applies when the link is
+            # opened elsewhere (e.g. in the mail client) before the email
+            # reached the replicas. Look for it on the primary too.
+            if not replica_databases() or routers.is_pinned():
+                return None
+            routers.pin_to_primary()
+            try:
+                email = self.select_related('user').get(
+                    verification_key=verification_key)
+            except self.model.DoesNotExist:
+                return None
+        return self._verify(email)
+
+    def verify_code(self, email, code):
+        """
+        Verify ``email`` with a short code sent along with the verification
+        link. Wrong codes are rejected by the cache without touching the
+        database.
+        """
+        if not code or not codes.check(email, code):
+            return None
+        routers.check_email(email)
         try:
-            email = self.get(verification_key=verification_key)
+            email_obj = self.select_related('user').get(email=email)
         except self.model.DoesNotExist:
             return None
-        if not email.verification_key_expired():
-            email.verification_key = self.model.VERIFIED
-            email.verified = True
-            email.save()
-            return email
+        email_obj = self._verify(email_obj)
+        if email_obj is not None:
+            codes.discard(email)
+        return email_obj
+
+    def _verify(self, email):
+        # Verification itself is one conditional UPDATE, so two concurrent
+        # requests can't both verify the same key. Callers are expected to
+        # run this inside a transaction.
+        verification_key = email.verification_key
+        if email.verification_key_expired():
+            return None
+
+        updates = {
+            'verification_key': self.model.VERIFIED,
+            'verified': True,
+            'expires_at': None,
+            'bounced': False,
+        }
+        if use_single_email():
+            updates['default'] = True
+
+        updated = self.filter(pk=email.pk, verification_key=verification_key,
+            expires_at__gt=datetime.datetime.now()).update(**updates)
+        if not updated:
+            return None
+
+        routers.record_write(email.user_id, email.email)
+        for name, value in updates.items():
+            setattr(email, name, value)
+        email._original_default = email.default
+        email._original_verified = True
+        UserEmailSummary.objects.adjust(email.user_id, verified=1,
+            default_email_id=email.id if use_single_email() else None)
+        stats.email_verified('pending')
+
+        if use_single_email():
+            self.filter(user=email.user).exclude(pk=email.pk).delete()
+            User.objects.filter(pk=email.user_id).update(email=email.email)
+            email.user.email = email.email
+
+        events.emit('email_verified', user_id=email.user_id,
+            email_id=email.id, email=email.email)
+        if use_single_email():
+            events.emit('default_email_changed', user_id=email.user_id,
+                email_id=email.id, email=email.email)
+        return email
+
+    def iter_for_users(self, user_ids, verified_only=False, chunk_size=500):
+        """
+        Yield dicts mapping user ids to lists of their emails (default email
+        first), one query and one dict per ``chunk_size`` users.
+        """
+        user_ids = list(user_ids)
+        for start in range(0, len(user_ids), chunk_size):
+            chunk = user_ids[start:start + chunk_size]
+            emails = self.filter(user__in=chunk).order_by('-default', 'id')
+            if verified_only:
+                emails = emails.filter(verified=True)
+
+            result = dict((user_id, []) for user_id in chunk)
+            for email in emails:
+                result[email.user_id].append(email)
+            yield result
+
+    def for_users(self, user_ids, verified_only=False, chunk_size=500):
+        """
+        Return a dict mapping each of ``user_ids`` to the list of its emails,
+        default email first.
+        """
+        result = {}
+        for chunk in self.iter_for_users(user_ids, verified_only, chunk_size):
+            result.update(chunk)
+        return result
+
+    def users_for_emails(self, emails, verified_only=True, chunk_size=500):
+        """
+        Return a dict mapping those of ``emails`` that belong to users to
+        the users.
+        """
+        emails = list(emails)
+        result = {}
+        for start in range(0, len(emails), chunk_size):
+            queryset = self.select_related('user').filter(
+                email__in=emails[start:start + chunk_size],
+                user__isnull=False)
+            if verified_only:
+                queryset = queryset.filter(verified=True)
+            for email in queryset:
+                result[email.email] = email.user
+        return result
+
+    def email_taken(self, email):
+        # Only emails the index reports as possibly taken cost a query.
+        if not emailindex.might_be_taken(email):
+            return False
+        return self.filter(email=email).exists()
 
     def delete_expired(self):
-        date_threshold = (datetime.datetime.now() -
-            datetime.timedelta(days=email_verification_days()))
-        expired_emails = self.filter(code_creation_date__lt=date_threshold)
-    
+        expired_emails = self.filter(expires_at__lte=datetime.datetime.now(),
+            verified=False).select_related('user')
+
         for email in expired_emails:
-            if not email.verified:
-                user = email.user
-                emails = user.useremail_set.all()
-                if not user.is_active:
-                    user.delete()
-                else:
-                    email.delete()
+            user = email.user
+            if user is not None and not user.is_active:
+                events.emit('user_expired', user_id=user.id,
+                    email=email.email)
+                user.delete()
+                stats.user_deleted(user)
+            else:
+                email.delete()
 
 
 class UserEmail(models.Model):
@@ -62,7 +186,9 @@ class UserEmail(models.Model):
         verbose_name = _('user email')
         verbose_name_plural = _('user emails')
 
-    VERIFIED = 'ALREADY_VERIFIED'
+    # Emails without an outstanding verification key have NULL in
+    # verification_key.
+    VERIFIED = None
 
     objects = UserEmailManager()
 
@@ -71,18 +197,32 @@ class UserEmail(models.Model):
     email = models.EmailField(unique=True)
     verified = models.BooleanField(default=False)
     code_creation_date = models.DateTimeField(default=datetime.datetime.now)
-    verification_key = models.CharField(_('verification key'), max_length=40)
+    # Set when a verification key is issued, NULL for verified emails
+    expires_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    verification_key = models.CharField(_('verification key'), max_length=40,
+        null=True, blank=True, unique=True)
+    # Set by ingestbounces for addresses that hard-bounced, no mail is sent
+    # to them until they are verified
+    bounced = models.BooleanField(_('bounced'), default=False)
 
     def __init__(self, *args, **kwds):
         super(UserEmail, self).__init__(*args, **kwds)
         self._original_default = self.default
+        self._original_verified = self.verified
 
     def __unicode__(self):
         return self.email
 
     def save(self, *args, **kwds):
+        # Saving also updates the user, the other default emails and the
+        # summary. Callers that need this to be atomic are expected to run
+        # it inside a transaction; managing one here would commit theirs.
+        created = self.id is None
         super(UserEmail, self).save(*args, **kwds)
-        if self.default and not self._original_default:
+        routers.record_write(self.user_id, self.email)
+
+        new_default = self.default and not self._original_default
+        if new_default:
             self.user.email = self.email
             self.user.save()
             for email in self.__class__.objects.filter(user=self.user):
@@ -90,12 +230,49 @@ class UserEmail(models.Model):
                     email.default = False
                     email.save()
 
+        if self.user_id is not None:
+            if created:
+                verified = int(self.verified)
+            else:
+                verified = int(self.verified) - int(self._original_verified)
+            UserEmailSummary.objects.adjust(self.user_id, emails=int(created),
+                verified=verified,
+                default_email_id=self.id if new_default else None)
+
+        if created:
+            stats.email_added(self)
+        elif self.verified and not self._original_verified:
+            stats.email_verified(stats.unverified_state(self.expires_at))
+        elif not self.verified and self._original_verified:
+            stats.email_unverified(stats.unverified_state(self.expires_at))
+
+        if created:
+            events.emit('email_added', user_id=self.user_id,
+                email_id=self.id, email=self.email)
+        if self.verified and (created or not self._original_verified):
+            events.emit('email_verified', user_id=self.user_id,
+                email_id=self.id, email=self.email)
+        if new_default:
+            events.emit('default_email_changed', user_id=self.user_id,
+                email_id=self.id, email=self.email)
+
+        self._original_default = self.default
+        self._original_verified = self.verified
+
     def make_new_key(self):
         self.verification_key = self.__class__.objects.make_random_key(
             self.email)
+        self.set_expiration()
+
+    def set_expiration(self):
         self.code_creation_date = datetime.datetime.now()
+        self.expires_at = self.code_creation_date + datetime.timedelta(
+            days=email_verification_days())
+
+    def send_verification_email(self, first_name=None, verification_path=None):
+        if self.bounced:
+            return
 
-    def send_verification_email(self, first_name=None):
         current_site = Site.objects.get_current()
         
         subject = render_to_string('emailauth/verification_email_subject.txt',
@@ -103,33 +280,361 @@ class UserEmail(models.Model):
         # Email subject *must not* contain newlines
         subject = ''.join(subject.splitlines())
 
-        emails = set()
-        if self.user is not None:
-            for email in self.__class__.objects.filter(user=self.user):
-                emails.add(email.email)
-        emails.add(self.email)
-        first_email = len(emails) == 1
+        if self.user_id is None:
+            first_email = True
+        else:
+            summary = UserEmailSummary.objects.get_for_user(self.user_id)
+            other_emails = summary.email_count
+            if self.id is not None:
+                other_emails -= 1
+            first_email = other_emails == 0
 
         if first_name is None:
             first_name = self.user.first_name
         
+        verification_code = None
+        if use_verification_codes() and self.verification_key is not None:
+            verification_code = codes.issue(self.email)
+
         message = render_to_string('emailauth/verification_email.txt', {
             'verification_key': self.verification_key,
+            'verification_code': verification_code,
+            'verification_path': verification_path,
             'expiration_days': email_verification_days(),
             'site': current_site,
             'first_name': first_name,
             'first_email': first_email,
         })
 
-        self.code_creation_date = datetime.datetime.now()
-
-        django.core.mail.send_mail(subject, message,
-            settings.DEFAULT_FROM_EMAIL, [self.email])
+        send_mail(subject, message, [self.email])
         
 
     def verification_key_expired(self):
-        expiration_date = datetime.timedelta(days=email_verification_days())
-        return (self.verification_key == self.VERIFIED or
-            (self.code_creation_date + expiration_date <= datetime.datetime.now()))
+        return (self.verification_key is None or self.expires_at is None or
+            self.expires_at <= datetime.datetime.now())
 
     verification_key_expired.boolean = True
+
+
+def attach_emails(users, verified_only=False, chunk_size=500):
+    """
+    Load emails of ``users`` with one query per ``chunk_size`` users and set
+    ``user.emails`` (default email first) and ``user.default_email`` on each
+    of them, e.g. before rendering a list of users.
+    """
+    users = list(users)
+    users_by_id = dict((user.id, user) for user in users)
+    for chunk in UserEmail.objects.iter_for_users(users_by_id,
+        verified_only, chunk_size):
+
+        for user_id, emails in chunk.items():
+            user = users_by_id[user_id]
+            user.emails = emails
+            user.default_email = None
+            if emails and emails[0].default:
+                user.default_email = emails[0]
+    return users
+
+
+def add_to_email_index(sender, instance, created, **kwds):
+    # Emails can also be changed on existing objects
+    emailindex.add_email(instance.email)
+
+post_save.connect(add_to_email_index, sender=UserEmail)
+
+
+class UserEmailSummaryManager(models.Manager):
+    def compute(self, user_ids):
+        """
+        Return a dict mapping user ids to ``(email_count, verified_count,
+        default_email_id)`` computed from UserEmail.
+        """
+        result = dict((user_id, [0, 0, None]) for user_id in user_ids)
+        emails = UserEmail.objects.filter(user__in=user_ids)
+
+        for row in emails.values('user').annotate(count=Count('id')):
+            result[row['user']][0] = row['count']
+        for row in emails.filter(verified=True).values('user').annotate(
+            count=Count('id')):
+
+            result[row['user']][1] = row['count']
+        for user_id, email_id in emails.filter(default=True).values_list(
+            'user', 'id'):
+
+            result[user_id][2] = email_id
+
+        return dict((user_id, tuple(values))
+            for user_id, values in result.items())
+
+    def reconcile(self, user_ids):
+        """
+        Bring summaries of the given users in line with their emails. Returns
+        the number of created or repaired summaries.
+
+        Runs in the caller's transaction if there is one and commits its own
+        otherwise.
+        """
+        using = router.db_for_write(self.model)
+        if transaction.is_managed(using=using):
+            return self._reconcile(user_ids)
+        return transaction.commit_on_success(using=using)(self._reconcile)(
+            user_ids)
+
+    def _reconcile(self, user_ids):
+        expected = self.compute(user_ids)
+        existing = dict((summary.user_id, summary)
+            for summary in self.filter(user__in=user_ids))
+
+        repaired = 0
+        for user_id, (email_count, verified_count, default_email_id) in (
+            expected.items()):
+
+            summary = existing.get(user_id)
+            if summary is None:
+                summary = UserEmailSummary(user_id=user_id)
+            elif (summary.email_count, summary.verified_count,
+                summary.default_email_id) == (email_count, verified_count,
+                default_email_id):
+
+                continue
+
+            summary.email_count = email_count
+            summary.verified_count = verified_count
+            summary.default_email_id = default_email_id
+            summary.version += 1
+            summary.save()
+            repaired += 1
+        return repaired
+
+    def get_for_user(self, user_id):
+        try:
+            return self.get(user=user_id)
+        except self.model.DoesNotExist:
+            pass
+
+        # Requests that find the summary missing at the same time all try to
+        # create it. The ones that lose the race read the row of the winner,
+        # which may not have reached the replicas yet.
+        using = router.db_for_write(self.model)
+        managed = transaction.is_managed(using=using)
+        if managed:
+            sid = transaction.savepoint(using=using)
+        try:
+            self.reconcile([user_id])
+        except IntegrityError:
+            if managed:
+                transaction.savepoint_rollback(sid, using=using)
+        else:
+            if managed:
+                transaction.savepoint_commit(sid, using=using)
+        return self.db_manager(using).get(user=user_id)
+
+    def adjust(self, user_id, emails=0, verified=0, default_email_id=None):
+        # Every change of the user's emails gets a new version, even when
+        # the counts stay the same.
+        updates = {'version': F('version') + 1}
+        if emails:
+            updates['email_count'] = F('email_count') + emails
+        if verified:
+            updates['verified_count'] = F('verified_count') + verified
+        if default_email_id is not None:
+            updates['default_email_id'] = default_email_id
+
+        # Missing summaries are computed from scratch when first needed.
+        self.filter(user=user_id).update(**updates)
+
+
+class UserEmailSummary(models.Model):
+    """
+    Per-user counts of emails, maintained by UserEmail.save() and on
+    UserEmail deletion. ``reconcileemailsummaries`` repairs them in bulk.
+    ``version`` changes whenever the user's emails do.
+    """
+
+    class Meta:
+        verbose_name = _('user email summary')
+        verbose_name_plural = _('user email summaries')
+
+    objects = UserEmailSummaryManager()
+
+    user = models.OneToOneField(User, primary_key=True,
+        verbose_name=_('user'))
+    email_count = models.PositiveIntegerField(default=0)
+    verified_count = models.PositiveIntegerField(default=0)
+    default_email_id = models.IntegerField(null=True, blank=True)
+    version = models.PositiveIntegerField(default=0)
+
+    def __unicode__(self):
+        return unicode(self.user_id)
+
+
+def update_summary_on_delete(sender, instance, **kwds):
+    if instance.user_id is None:
+        return
+    updates = {
+        'email_count': F('email_count') - 1,
+        'version': F('version') + 1,
+    }
+    if instance.verified:
+        updates['verified_count'] = F('verified_count') - 1
+    summaries = UserEmailSummary.objects.filter(user=instance.user_id)
+    summaries.update(**updates)
+    summaries.filter(default_email_id=instance.id).update(
+        default_email_id=None)
+
+post_delete.connect(update_summary_on_delete, sender=UserEmail)
+
+
+def update_stats_on_delete(sender, instance, **kwds):
+    stats.email_deleted(instance)
+    routers.record_write(instance.user_id, instance.email)
+
+post_delete.connect(update_stats_on_delete, sender=UserEmail)
+
+
+class PasswordResetTokenManager(models.Manager):
+    def create_token(self, user_email):
+        if use_automaintenance():
+            self.delete_expired()
+        # Like the single reset key of old, a new link replaces the earlier
+        # ones of the email.
+        self.filter(user_email=user_email).delete()
+
+        now = datetime.datetime.now()
+        token = PasswordResetToken(user_email=user_email,
+            key=UserEmail.objects.make_random_key(user_email.email),
+            expires_at=now + datetime.timedelta(days=password_reset_days()))
+        token.save()
+        return token
+
+    def get_valid(self, key):
+        try:
+            return self.select_related('user_email', 'user_email__user').get(
+                key=key, expires_at__gt=datetime.datetime.now())
+        except self.model.DoesNotExist:
+            return None
+
+    def consume(self, token):
+        # Expiring the tokens is one conditional UPDATE on the token being
+        # still valid, so only one request may ever use it, and it also
+        # ends the other links sent to the emails of the user. Consumed
+        # tokens are purged with expired ones.
+        now = datetime.datetime.now()
+        connection = connections[router.db_for_write(self.model)]
+        qn = connection.ops.quote_name
+        used = ('EXISTS (SELECT 1 FROM %s used WHERE used.%s = %%s AND '
+            'used.%s > %%s)' % (qn(self.model._meta.db_table),
+            qn(self.model._meta.pk.column),
+            qn(self.model._meta.get_field('expires_at').column)))
+
+        emails = UserEmail.objects.filter(user=token.user_email.user_id)
+        tokens = self.filter(user_email__in=emails.values('pk'),
+            expires_at__gt=now)
+        return bool(tokens.extra(where=[used], params=[token.pk,
+            connection.ops.value_to_db_datetime(now)]).update(expires_at=now))
+
+    def delete_expired(self):
+        self.filter(expires_at__lte=datetime.datetime.now()).delete()
+
+
+class PasswordResetToken(models.Model):
+    class Meta:
+        verbose_name = _('password reset token')
+        verbose_name_plural = _('password reset tokens')
+
+    objects = PasswordResetTokenManager()
+
+    user_email = models.ForeignKey(UserEmail, verbose_name=_('user email'))
+    key = models.CharField(_('reset key'), max_length=40, unique=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    def __unicode__(self):
+        return self.key
+
+    def expired(self):
+        return self.expires_at <= datetime.datetime.now()
+
+    expired.boolean = True
+
+
+class UserSessionManager(models.Manager):
+    def add(self, user, session):
+        self.filter(session_key=session.session_key).delete()
+        UserSession(user=user, session_key=session.session_key,
+            expire_date=session.get_expiry_date()).save()
+
+    def invalidate(self, user, keep_session_key=None):
+        """
+        End all sessions of ``user`` except ``keep_session_key``.
+        """
+        user_sessions = self.filter(user=user)
+        if keep_session_key is not None:
+            user_sessions = user_sessions.exclude(session_key=keep_session_key)
+        session_keys = list(user_sessions.values_list('session_key',
+            flat=True))
+        if not session_keys:
+            return
+
+        if settings.SESSION_ENGINE == 'django.contrib.sessions.backends.db':
+            from django.contrib.sessions.models import Session
+            Session.objects.filter(session_key__in=session_keys).delete()
+        else:
+            from django.utils.importlib import import_module
+            engine = import_module(settings.SESSION_ENGINE)
+            for session_key in session_keys:
+                engine.SessionStore(session_key).delete()
+
+        self.filter(session_key__in=session_keys).delete()
+
+    def delete_expired(self):
+        self.filter(expire_date__lt=datetime.datetime.now()).delete()
+
+
+class UserSession(models.Model):
+    """
+    Sessions started by emailauth's login views, indexed by user.
+    """
+
+    class Meta:
+        verbose_name = _('user session')
+        verbose_name_plural = _('user sessions')
+
+    objects = UserSessionManager()
+
+    user = models.ForeignKey(User, verbose_name=_('user'))
+    session_key = models.CharField(max_length=40, unique=True)
+    expire_date = models.DateTimeField(db_index=True)
+
+    def __unicode__(self):
+        return self.session_key
+
+
+class PendingEventManager(models.Manager):
+    def metrics(self):
+        depth = self.count()
+        lag = 0.0
+        if depth:
+            oldest = self.order_by('id')[0].created
+            delta = datetime.datetime.now() - oldest
+            lag = delta.days * 86400 + delta.seconds
+        return {'depth': depth, 'lag': lag}
+
+
+class PendingEvent(models.Model):
+    """
+    An emailauth event waiting for ``dispatchemailauthevents``, used with
+    ``EMAILAUTH_EVENT_DISPATCH = 'table'``.
+    """
+
+    class Meta:
+        verbose_name = _('pending event')
+        verbose_name_plural = _('pending events')
+
+    objects = PendingEventManager()
+
+    name = models.CharField(max_length=40)
+    payload = models.TextField()
+    created = models.DateTimeField(default=datetime.datetime.now)
+
+    def __unicode__(self):
+        return self.name
@@ -0,0 +1,167 @@
+import logging
+import logging.handlers
+import threading
+import time
+
+from django.template import Template
+from django.utils import simplejson
+
+from emailauth.utils import (profile_file, profile_file_size,
+    profile_file_count, profile_flush_interval)
+
+
+_state = threading.local()
+
+_lock = threading.Lock()
+_aggregates = {}
+_last_flush = time.time()
+_logger = None
+
+STAT_NAMES = ('queries', 'query_time', 'render_time', 'mail_time',
+    'total_time')
+
+
+def is_active():
+    return getattr(_state, 'stats', None) is not None
+
+
+def start():
+    _state.stats = dict((name, 0) for name in STAT_NAMES)
+    _state.render_depth = 0
+
+
+def stop():
+    stats = getattr(_state, 'stats', None)
+    _state.stats = None
+    return stats
+
+
+def add(name, value):
+    stats = getattr(_state, 'stats', None)
+    if stats is not None:
+        stats[name] += value
+
+
+class timer(object):
+    """
+    Decorator adding the running time of a function to the current request's
+    ``name`` stat.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __call__(self, func):
+        name = self.name
+        def wrapper(*args, **kwds):
+            if not is_active():
+                return func(*args, **kwds)
+            started = time.time()
+            try:
+                return func(*args, **kwds)
+            finally:
+                add(name, time.time() - started)
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+
+
+class ProfilingCursor(object):
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, *args):
+        started = time.time()
+        try:
+            return self.cursor.execute(*args)
+        finally:
+            add('queries', 1)
+            add('query_time', time.time() - started)
+
+    def executemany(self, *args):
+        started = time.time()
+        try:
+            return self.cursor.executemany(*args)
+        finally:
+            add('queries', 1)
+            add('query_time', time.time() - started)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+
+_original_render = Template.render
+
+def _profiled_render(self, context):
+    if not is_active():
+        return _original_render(self, context)
+
+    # Included templates are rendered inside their parents
+    _state.render_depth += 1
+    started = time.time()
+    try:
+        return _original_render(self, context)
+    finally:
+        _state.render_depth -= 1
+        if _state.render_depth == 0:
+            add('render_time', time.time() - started)
+
+_installed = False
+
+def install():
+    global _installed
+    if not _installed:
+        Template.render = _profiled_render
+        _installed = True
+
+
+def _get_logger():
+    global _logger
+    if _logger is None:
+        logger = logging.getLogger('emailauth.profile')
+        logger.propagate = False
+        logger.setLevel(logging.INFO)
+        logger.addHandler(logging.handlers.RotatingFileHandler(
+            profile_file(), maxBytes=profile_file_size(),
+            backupCount=profile_file_count()))
+        _logger = logger
+    return _logger
+
+
+def record(view_name, stats):
+    """
+    Add stats of a request to the aggregates of ``view_name``. Aggregates are
+    written to ``EMAILAUTH_PROFILE_FILE`` every
+    ``EMAILAUTH_PROFILE_FLUSH_INTERVAL`` seconds, one JSON line per view.
+    """
+    global _last_flush
+
+    _lock.acquire()
+    try:
+        aggregate = _aggregates.setdefault(view_name,
+            dict([('requests', 0)] + [(name, 0) for name in STAT_NAMES] +
+            [('max_' + name, 0) for name in STAT_NAMES]))
+        aggregate['requests'] += 1
+        for name in STAT_NAMES:
+            aggregate[name] += stats[name]
+            aggregate['max_' + name] = max(aggregate['max_' + name],
+                stats[name])
+
+        now = time.time()
+        if now - _last_flush < profile_flush_interval():
+            return
+        aggregates = _aggregates.items()
+        _aggregates.clear()
+        started, _last_flush = _last_flush, now
+    finally:
+        _lock.release()
+
+    logger = _get_logger()
+    for view_name, aggregate in aggregates:
+        aggregate['view'] = view_name
+        aggregate['start'] = started
+        aggregate['end'] = now
+        logger.info(simplejson.dumps(aggregate))
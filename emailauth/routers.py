@@ -0,0 +1,124 @@
+import random
+import threading
+
+from django.core.cache import cache
+from django.utils.hashcompat import md5_constructor
+
+from emailauth.utils import replica_databases, replica_pin_seconds
+
+
+_state = threading.local()
+
+
+def pin_to_primary():
+    _state.pinned = True
+
+
+def is_pinned():
+    return getattr(_state, 'pinned', False) or has_written()
+
+
+def has_written():
+    return getattr(_state, 'written', False)
+
+
+def reset():
+    _state.pinned = False
+    _state.written = False
+    _state.written_users = set()
+    _state.written_emails = set()
+
+
+def _user_key(user_id):
+    return 'emailauth-primary-user-%s' % user_id
+
+
+def _email_key(email):
+    return 'emailauth-primary-email-%s' % md5_constructor(
+        email.lower().encode('utf-8')).hexdigest()
+
+
+def record_write(user_id=None, email=None):
+    """
+    Note that emails of ``user_id`` or ``email`` have changed in this
+    request, see pin_written().
+    """
+    if not replica_databases():
+        return
+    if not hasattr(_state, 'written_users'):
+        reset()
+    if user_id is not None:
+        _state.written_users.add(user_id)
+    if email:
+        _state.written_emails.add(email)
+
+
+def pin_written():
+    """
+    Keep reads concerning users and emails changed in this request on the
+    primary for ``EMAILAUTH_REPLICA_PIN_SECONDS``, whichever session or
+    browser they come from.
+    """
+    pins = {}
+    for user_id in getattr(_state, 'written_users', ()):
+        pins[_user_key(user_id)] = True
+    for email in getattr(_state, 'written_emails', ()):
+        pins[_email_key(email)] = True
+    for key in pins:
+        cache.set(key, True, replica_pin_seconds())
+
+
+def check_user(user_id):
+    """Pin this request to the primary if ``user_id`` is pinned."""
+    if replica_databases() and cache.get(_user_key(user_id)):
+        pin_to_primary()
+
+
+def check_email(email):
+    """Pin this request to the primary if ``email`` is pinned."""
+    if replica_databases() and email and cache.get(_email_key(email)):
+        pin_to_primary()
+
+
+class ReplicaRouter(object):
+    """
+    Send reads of emailauth models to one of ``EMAILAUTH_REPLICA_DATABASES``
+    and writes to the primary ('default') database.
+
+    Once emailauth data is written, reads in the current thread go to the
+    primary. ``emailauth.middleware.ReplicaPinningMiddleware`` resets that
+    state per request and keeps the session, as well as users and email
+    addresses whose emails were written, pinned to the primary for
+    ``EMAILAUTH_REPLICA_PIN_SECONDS``, so that e.g. login right after
+    verification in another browser sees the verified email.
+    """
+
+    app_label = 'emailauth'
+    primary = 'default'
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label != self.app_label:
+            return None
+        replicas = replica_databases()
+        if not replicas or is_pinned():
+            return self.primary
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label != self.app_label:
+            # Objects of other apps read along with emailauth's (e.g. users
+            # with select_related) must not be written to a replica.
+            instance = hints.get('instance')
+            if (instance is not None and
+                instance._state.db in replica_databases()):
+
+                return self.primary
+            return None
+        _state.written = True
+        return self.primary
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = [self.primary] + list(replica_databases())
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
@@ -0,0 +1,83 @@
+import base64
+import hmac
+import time
+
+from django.conf import settings
+from django.utils import simplejson
+from django.utils.hashcompat import sha_constructor
+
+
+class BadSignature(Exception):
+    pass
+
+
+class SignatureExpired(BadSignature):
+    pass
+
+
+def b64_encode(s):
+    return base64.urlsafe_b64encode(s).rstrip('=')
+
+
+def b64_decode(s):
+    s = str(s)
+    return base64.urlsafe_b64decode(s + '=' * (-len(s) % 4))
+
+
+def salted_hmac(salt, value):
+    key = sha_constructor(salt + settings.SECRET_KEY).digest()
+    return hmac.new(key, msg=value, digestmod=sha_constructor)
+
+
+def constant_time_compare(val1, val2):
+    """
+    Compare two strings in time independent of the position of the first
+    difference.
+    """
+    if len(val1) != len(val2):
+        return False
+    result = 0
+    for x, y in zip(val1, val2):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+
+def signature(value, salt):
+    return b64_encode(salted_hmac(salt, value).digest())
+
+
+def dumps(obj, salt):
+    """
+    Return a URL safe token holding ``obj`` (anything JSON serializable) and
+    the current time, signed with SECRET_KEY.
+    """
+    value = '%s.%s' % (b64_encode(simplejson.dumps(obj)),
+        b64_encode(str(int(time.time()))))
+    return '%s.%s' % (value, signature(value, salt))
+
+
+def loads(token, salt, max_age):
+    """
+    Return the object stored in ``token`` by dumps(). Raises BadSignature
+    for tampered tokens and SignatureExpired for tokens older than
+    ``max_age`` seconds.
+    """
+    try:
+        data, timestamp, sig = str(token).split('.')
+    except (ValueError, UnicodeEncodeError):
+        raise BadSignature()
+
+    if not constant_time_compare(sig, signature('%s.%s' % (data, timestamp),
+        salt)):
+
+        raise BadSignature()
+
+    try:
+        timestamp = int(b64_decode(timestamp))
+        obj = simplejson.loads(b64_decode(data))
+    except (TypeError, ValueError):
+        raise BadSignature()
+
+    if timestamp + max_age < time.time():
+        raise SignatureExpired()
+    return obj
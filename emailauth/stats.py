@@ -0,0 +1,133 @@
+import datetime
+import time
+
+from django.core.cache import cache
+from django.db import connection
+
+from emailauth.utils import stats_cache_timeout, use_incremental_stats
+
+
+CACHE_PREFIX = 'emailauth_stats:'
+
+COUNTERS = ('emails', 'verified', 'unverified', 'pending', 'expired',
+    'inactive_users')
+
+
+def compute():
+    """
+    Count emails by state in a single GROUP BY pass over UserEmail and
+    inactive users in one more query.
+    """
+    from django.contrib.auth.models import User
+    from emailauth.models import UserEmail
+
+    qn = connection.ops.quote_name
+    state = ('CASE WHEN %(verified)s THEN 1 WHEN %(expires_at)s > %%s THEN 2 '
+        'ELSE 3 END' % {
+            'verified': qn('verified'),
+            'expires_at': qn('expires_at'),
+        })
+    cursor = connection.cursor()
+    cursor.execute('SELECT %s, COUNT(*) FROM %s GROUP BY %s' % (state,
+        qn(UserEmail._meta.db_table), state),
+        [datetime.datetime.now()] * 2)
+    by_state = dict(cursor.fetchall())
+
+    stats = {
+        'verified': by_state.get(1, 0),
+        'pending': by_state.get(2, 0),
+        'expired': by_state.get(3, 0),
+        'inactive_users': User.objects.filter(is_active=False).count(),
+    }
+    stats['unverified'] = stats['pending'] + stats['expired']
+    stats['emails'] = stats['verified'] + stats['unverified']
+    return stats
+
+
+def get_stats(refresh=False):
+    """
+    Return cached stats, recomputing them when they aren't cached (or
+    ``refresh`` is true). ``computed_at`` holds the time of the last full
+    recomputation.
+    """
+    keys = [CACHE_PREFIX + name for name in COUNTERS + ('computed_at',)]
+    if not refresh:
+        cached = cache.get_many(keys)
+        if len(cached) == len(keys):
+            return dict((key[len(CACHE_PREFIX):], value)
+                for key, value in cached.items())
+
+    stats = compute()
+    stats['computed_at'] = time.time()
+    for name, value in stats.items():
+        cache.set(CACHE_PREFIX + name, value, stats_cache_timeout())
+    return stats
+
+
+def adjust(**deltas):
+    """
+    Apply counter changes to cached stats in incremental mode. Counters that
+    aren't cached are left alone, they are computed on the next read.
+    """
+    if not use_incremental_stats():
+        return
+    for name, delta in deltas.items():
+        if not delta:
+            continue
+        try:
+            if delta > 0:
+                cache.incr(CACHE_PREFIX + name, delta)
+            else:
+                cache.decr(CACHE_PREFIX + name, -delta)
+        except ValueError:
+            pass
+
+
+def unverified_state(expires_at):
+    if expires_at is not None and expires_at > datetime.datetime.now():
+        return 'pending'
+    return 'expired'
+
+
+def email_state(email):
+    if email.verified:
+        return 'verified'
+    return unverified_state(email.expires_at)
+
+
+def email_added(email):
+    state = email_state(email)
+    deltas = {'emails': 1, state: 1}
+    if state != 'verified':
+        deltas['unverified'] = 1
+    adjust(**deltas)
+
+
+def email_verified(previous_state):
+    adjust(verified=1, unverified=-1, **{previous_state: -1})
+
+
+def email_unverified(new_state):
+    adjust(verified=-1, unverified=1, **{new_state: 1})
+
+
+def user_created(user):
+    if not user.is_active:
+        adjust(inactive_users=1)
+
+
+def user_activated():
+    adjust(inactive_users=-1)
+
+
+def user_deleted(user):
+    if not user.is_active:
+        adjust(inactive_users=-1)
+
+
+def email_deleted(email):
+    state = email_state(email)
+    deltas = {'emails': -1, state: -1}
+    if state != 'verified':
+        deltas['unverified'] = -1
+    adjust(**deltas)
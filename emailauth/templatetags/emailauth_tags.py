@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 from django import template
 from emailauth.forms import LoginForm
+from emailauth.context_processors import get_user_emails
 
 register = template.Library()
 
@@ -8,4 +9,26 @@ register = template.Library()
 def loginform(context):
     form = LoginForm()
     user = context['request'].user
-    return locals()
\ No newline at end of file
+    return locals()
+
+
+class UserEmailsNode(template.Node):
+    def __init__(self, var_name):
+        self.var_name = var_name
+
+    def render(self, context):
+        context[self.var_name] = get_user_emails(context['request'])
+        return ''
+
+
+@register.tag
+def user_emails(parser, token):
+    """
+    {% user_emails as emails %} puts the current user's emails into the
+    context, see emailauth.context_processors.UserEmails.
+    """
+    bits = token.split_contents()
+    if len(bits) != 3 or bits[1] != 'as':
+        raise template.TemplateSyntaxError(
+            "'%s' tag syntax is {%% %s as variable %%}" % (bits[0], bits[0]))
+    return UserEmailsNode(bits[2])
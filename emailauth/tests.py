@@ -1,14 +1,22 @@
+import os
 import re
+import shutil
+import tempfile
 from datetime import datetime, timedelta
 
 from django.test.client import Client
-from django.test.testcases import TestCase
+from django.test.testcases import TestCase, TransactionTestCase
 from django.core import mail
 from django.contrib.auth.models import User
 from django.conf import settings
 
-from emailauth.models import UserEmail
-from emailauth.utils import email_verification_days
+from emailauth.models import UserEmail, PasswordResetToken, UserEmailSummary
+from emailauth.utils import email_verification_days, use_single_email
+from emailauth import routers
+from emailauth.bloom import BloomFilter
+from emailauth.mail import DomainScheduler
+from emailauth.routers import ReplicaRouter
+from emailauth.middleware import ReplicaPinningMiddleware
 
 
 class Status:
@@ -39,6 +47,23 @@ class BaseTestCase(TestCase):
         user_email.save()
         return user, user_email
 
+    def getQueries(self):
+        # Reads may go to replicas, see settings_replicas. Test mirrors may
+        # share the connection object of the primary.
+        from django.db import connections
+        queries = []
+        seen = set()
+        for conn in connections.all():
+            if id(conn) not in seen:
+                seen.add(id(conn))
+                queries.extend(conn.queries)
+        return queries
+
+    def resetQueries(self):
+        from django.db import connections
+        for conn in connections.all():
+            conn.queries = []
+
     def getLoggedInClient(self, email='user@example.com', password='password'):
         client = Client()
         client.login(username=email, password=password)
@@ -80,6 +105,59 @@ class RegisterTest(BaseTestCase):
         user = User.objects.get(email='user@example.com')
         self.assertEqual(user.first_name, 'John')
 
+    def testMessages(self):
+        from django.contrib.auth.models import Message
+        client = Client()
+        response = client.post('/register/', {
+            'email': 'user@example.com',
+            'first_name': 'John',
+            'password1': 'password',
+            'password2': 'password',
+        })
+        response = client.get('/register/continue/user%40example.com/')
+        self.assertContains(response, 'Welcome to')
+
+        addr_re = re.compile(r'.*http://.*?(/\S*/)', re.UNICODE | re.MULTILINE)
+        verification_url = addr_re.search(mail.outbox[0].body).groups()[0]
+        response = client.get(verification_url, follow=True)
+        self.assertContains(response, 'user@example.com email confirmed.')
+        self.assertEqual(Message.objects.count(), 0)
+
+    def testStatelessRegister(self):
+        settings.EMAILAUTH_STATELESS_REGISTRATION = True
+        try:
+            client = Client()
+            response = client.post('/register/', {
+                'email': 'user@example.com',
+                'first_name': 'John',
+                'password1': 'password',
+                'password2': 'password',
+            })
+            self.assertRedirects(response,
+                '/register/continue/user%40example.com/')
+            self.assertEqual(User.objects.count(), 0)
+            self.assertEqual(UserEmail.objects.count(), 0)
+
+            addr_re = re.compile(r'.*http://.*?(/\S*/)', re.UNICODE | re.MULTILINE)
+            verification_url = addr_re.search(mail.outbox[0].body).groups()[0]
+
+            response = client.get(verification_url[:-2] + 'x/')
+            self.assertContains(response, 'Not verified')
+            self.assertEqual(User.objects.count(), 0)
+
+            response = client.get(verification_url)
+            self.assertRedirects(response, '/account/')
+
+            user_email = UserEmail.objects.get(email='user@example.com')
+            self.assertTrue(user_email.verified)
+            self.assertTrue(user_email.user.is_active)
+            self.assertTrue(user_email.user.check_password('password'))
+
+            response = Client().get(verification_url)
+            self.assertContains(response, 'Not verified')
+        finally:
+            settings.EMAILAUTH_STATELESS_REGISTRATION = False
+
     def testRegisterSame(self):
         user, user_email = self.createActiveUser()
         client = Client()
@@ -105,10 +183,209 @@ class RegisterTest(BaseTestCase):
         
 
 
+class VerifyTest(BaseTestCase):
+    def createUnverifiedEmail(self, email='user@example.org'):
+        user, user_email = self.createActiveUser()
+        email_obj = UserEmail.objects.create_unverified_email(email, user)
+        email_obj.save()
+        return email_obj
+
+    def testVerifyTwice(self):
+        email_obj = self.createUnverifiedEmail()
+        key = email_obj.verification_key
+
+        verified = UserEmail.objects.verify(key)
+        self.assertEqual(verified.id, email_obj.id)
+        self.assertTrue(UserEmail.objects.get(id=email_obj.id).verified)
+
+        self.assertEqual(UserEmail.objects.verify(key), None)
+
+    def testVerifyExpired(self):
+        email_obj = self.createUnverifiedEmail()
+        email_obj.expires_at = datetime.now() - timedelta(seconds=1)
+        email_obj.save()
+
+        self.assertEqual(UserEmail.objects.verify(email_obj.verification_key),
+            None)
+        self.assertFalse(UserEmail.objects.get(id=email_obj.id).verified)
+
+    def testVerifyCode(self):
+        settings.EMAILAUTH_VERIFICATION_CODES = True
+        try:
+            email_obj = self.createUnverifiedEmail()
+            email_obj.send_verification_email()
+            code = re.search(r'code: (\d+)', mail.outbox[-1].body).group(1)
+
+            self.assertEqual(UserEmail.objects.verify_code('user@example.org',
+                '%06d' % ((int(code) + 1) % 1000000)), None)
+            client = Client()
+            response = client.post('/api/verify/code/', {
+                'email': 'user@example.org',
+                'code': code,
+            })
+            self.assertStatusCode(response)
+            self.assertTrue(UserEmail.objects.get(id=email_obj.id).verified)
+            self.assertEqual(UserEmail.objects.verify_code('user@example.org',
+                code), None)
+        finally:
+            settings.EMAILAUTH_VERIFICATION_CODES = False
+
+    def testVerifyCodeAttempts(self):
+        settings.EMAILAUTH_VERIFICATION_CODES = True
+        try:
+            email_obj = self.createUnverifiedEmail()
+            email_obj.send_verification_email()
+            code = re.search(r'code: (\d+)', mail.outbox[-1].body).group(1)
+            wrong = '%06d' % ((int(code) + 1) % 1000000)
+
+            for i in range(5):
+                self.assertEqual(UserEmail.objects.verify_code(
+                    'user@example.org', wrong), None)
+            self.assertEqual(UserEmail.objects.verify_code('user@example.org',
+                code), None)
+            self.assertFalse(UserEmail.objects.get(id=email_obj.id).verified)
+        finally:
+            settings.EMAILAUTH_VERIFICATION_CODES = False
+
+    def testVerifyCodeCountsFirst(self):
+        from django.core.cache import cache
+        from emailauth import codes
+        from emailauth.utils import verification_code_attempts
+        code = codes.issue('user@example.org')
+        # Attempts that are still running have been counted already
+        cache.set(codes._key('code-attempts', 'user@example.org'),
+            verification_code_attempts())
+
+        self.assertFalse(codes.check('user@example.org', code))
+        self.assertEqual(cache.get(codes._key('code', 'user@example.org')),
+            None)
+
+    def testExpirationIsStored(self):
+        email_obj = self.createUnverifiedEmail()
+        settings.EMAILAUTH_VERIFICATION_DAYS = 0
+        try:
+            self.assertFalse(email_obj.verification_key_expired())
+            verified = UserEmail.objects.verify(email_obj.verification_key)
+            self.assertEqual(verified.id, email_obj.id)
+            self.assertEqual(verified.expires_at, None)
+        finally:
+            settings.EMAILAUTH_VERIFICATION_DAYS = 3
+
+    def testVerifyQueryCount(self):
+        email_obj = self.createUnverifiedEmail()
+        User.objects.filter(id=email_obj.user_id).update(is_active=False)
+
+        settings.DEBUG = True
+        try:
+            self.resetQueries()
+            response = Client().get('/verify/%s/' % email_obj.verification_key)
+            self.assertStatusCode(response, Status.REDIRECT)
+            queries = [query['sql'] for query in self.getQueries()]
+        finally:
+            settings.DEBUG = False
+
+        # One SELECT of the email together with its user and one conditional
+        # UPDATE each for verification and activation
+        emails = [sql for sql in queries if '"emailauth_useremail"' in sql]
+        self.assertEqual(len(emails), 2)
+        self.assertTrue('JOIN "auth_user"' in emails[0])
+        self.assertTrue(emails[1].startswith('UPDATE'))
+        self.assertEqual(len([sql for sql in queries
+            if sql.startswith('UPDATE "auth_user" SET "is_active"')]), 1)
+        self.assertTrue(User.objects.get(id=email_obj.user_id).is_active)
+
+
+class ApiTest(BaseTestCase):
+    def testRegisterVerifyLogin(self):
+        client = Client()
+        response = client.post('/api/register/', {
+            'email': 'user@example.com',
+            'first_name': 'John',
+            'password1': 'password',
+            'password2': 'password',
+        })
+        self.assertContains(response, '"ok": true')
+        self.assertEqual(len(mail.outbox), 1)
+
+        response = client.post('/api/register/', {
+            'email': 'user@example.com',
+            'first_name': 'John',
+            'password1': 'password',
+            'password2': 'password',
+        })
+        self.assertContains(response, 'This email is already taken',
+            status_code=400)
+
+        user_email = UserEmail.objects.get(email='user@example.com')
+        response = client.post('/api/verify/', {
+            'verification_key': user_email.verification_key,
+        })
+        self.assertContains(response, '"verified": true')
+        self.assertTrue(User.objects.get(id=user_email.user_id).is_active)
+
+        response = Client().post('/api/login/', {
+            'email': 'user@example.com',
+            'password': 'password',
+        })
+        self.assertContains(response, '"ok": true')
+
+    def testLoginFail(self):
+        user, user_email = self.createActiveUser()
+        response = Client().post('/api/login/', {
+            'email': 'user@example.com',
+            'password': 'wrongpassword',
+        })
+        self.assertStatusCode(response, 400)
+
+    def testPasswordReset(self):
+        user, user_email = self.createActiveUser()
+        client = Client()
+        response = client.post('/api/resetpassword/',
+            {'email': 'user@example.com'})
+        self.assertContains(response, '"ok": true')
+
+        token = PasswordResetToken.objects.get(user_email=user_email)
+        response = client.post('/api/resetpassword/confirm/', {
+            'reset_code': token.key,
+            'password1': 'newpassword',
+            'password2': 'newpassword',
+        })
+        self.assertContains(response, '"ok": true')
+        self.assertTrue(User.objects.get(id=user.id).check_password(
+            'newpassword'))
+
+
 class LoginTest(BaseTestCase):
     def testLoginGet(self):
         self.checkSimplePage('/login/')
 
+    def testLoginSingleRedirect(self):
+        user, user_email = self.createActiveUser()
+        client = Client(HTTP_HOST='example.com')
+        response = client.get('/login/')
+        self.assertStatusCode(response, Status.OK)
+
+        response = client.post('/login/', {
+            'email': 'user@example.com',
+            'password': 'password',
+        })
+        self.assertStatusCode(response, Status.REDIRECT)
+        self.assertEqual(response['Location'], 'http://example.com/account/')
+
+    def testLoginNoCookies(self):
+        user, user_email = self.createActiveUser()
+        client = Client(HTTP_HOST='example.com')
+        response = client.post('/login/', {
+            'email': 'user@example.com',
+            'password': 'password',
+        })
+        self.assertStatusCode(response, Status.REDIRECT)
+        self.assertTrue('testcookiesupport' in response['Location'])
+
+        client.cookies.clear()
+        response = client.get('/login/?testcookiesupport=')
+        self.assertContains(response, 'have cookies enabled')
+
     def testLoginFail(self):
         user, user_email = self.createActiveUser()
         client = Client()
@@ -157,26 +434,87 @@ class PasswordResetTest(BaseTestCase):
         self.assertStatusCode(response, Status.NOT_FOUND)
 
 
+    def testPasswordResetEndsOtherSessions(self):
+        reset_url, user_email = self.prepare()
+
+        other_client = Client()
+        response = other_client.post('/login/', {
+            'email': user_email.email,
+            'password': 'password',
+        })
+        self.assertRedirects(response, '/account/')
+        self.assertStatusCode(other_client.get('/account/'))
+
+        client = Client()
+        response = client.post(reset_url, {
+            'password1': 'newpassword',
+            'password2': 'newpassword',
+        })
+        self.assertRedirects(response, '/account/')
+        self.assertStatusCode(client.get('/account/'))
+
+        response = other_client.get('/account/')
+        self.assertStatusCode(response, Status.REDIRECT)
+
     def testPasswordResetFail(self):
         reset_url, user_email = self.prepare()
         client = Client()
-        user_email.verification_key = UserEmail.VERIFIED
-        user_email.save()
+        token = PasswordResetToken.objects.get(user_email=user_email)
+        self.assertTrue(PasswordResetToken.objects.consume(token))
+        self.assertFalse(PasswordResetToken.objects.consume(token))
 
         response = client.get(reset_url)
         self.assertStatusCode(response, Status.NOT_FOUND)
 
+    def testPasswordResetEndsOtherLinks(self):
+        reset_url, user_email = self.prepare()
+        other_email = UserEmail(user=user_email.user, email='user@example.org',
+            verified=True, verification_key=UserEmail.VERIFIED)
+        other_email.save()
+        first = PasswordResetToken.objects.create_token(user_email)
+        self.assertFalse(PasswordResetToken.objects.filter(
+            key=reset_url.split('/')[-2]).exists())
+        other = PasswordResetToken.objects.create_token(other_email)
+
+        client = Client()
+        response = client.post('/resetpassword/%s/' % other.key, {
+            'password1': 'newpassword',
+            'password2': 'newpassword',
+        })
+        self.assertRedirects(response, '/account/')
+
+        response = client.post('/resetpassword/%s/' % first.key, {
+            'password1': 'otherpassword',
+            'password2': 'otherpassword',
+        })
+        self.assertStatusCode(response, Status.NOT_FOUND)
+        user = User.objects.get(id=user_email.user_id)
+        self.assertTrue(user.check_password('newpassword'))
+        self.assertFalse(PasswordResetToken.objects.consume(first))
+
 
     def testPasswordResetFail2(self):
         reset_url, user_email = self.prepare()
         client = Client()
-        user_email.code_creation_date = (datetime.now() -
-            timedelta(days=email_verification_days() + 1))
-        user_email.save()
+        token = PasswordResetToken.objects.get(user_email=user_email)
+        token.expires_at = datetime.now() - timedelta(seconds=1)
+        token.save()
 
         response = client.get(reset_url)
         self.assertStatusCode(response, Status.NOT_FOUND)
 
+    def testPasswordResetDoesNotTouchUserEmail(self):
+        reset_url, user_email = self.prepare()
+        self.assertEqual(UserEmail.objects.get(id=user_email.id).verification_key,
+            UserEmail.VERIFIED)
+
+        PasswordResetToken.objects.filter(user_email=user_email).update(
+            expires_at=datetime.now() - timedelta(seconds=1))
+        PasswordResetToken.objects.delete_expired()
+
+        self.assertEqual(PasswordResetToken.objects.count(), 0)
+        self.assertEqual(UserEmail.objects.filter(id=user_email.id).count(), 1)
+
 
 class TestAddEmail(BaseTestCase):
     def setUp(self):
@@ -327,6 +665,31 @@ class TestDeleteEmail(BaseTestCase):
         self.assertStatusCode(response, Status.NOT_FOUND)
 
 
+class TestUserEmailsContext(BaseTestCase):
+    def testUserEmails(self):
+        from emailauth.context_processors import UserEmails
+
+        user, user_email = self.createActiveUser()
+        UserEmail(user=user, email='user@example.org', verified=True).save()
+        UserEmail(user=user, email='user@example.net',
+            verification_key='abcdef').save()
+
+        settings.DEBUG = True
+        try:
+            queries = len(self.getQueries())
+            user_emails = UserEmails(user)
+            self.assertEqual(len(self.getQueries()), queries)
+
+            self.assertEqual(user_emails.default.id, user_email.id)
+            self.assertEqual([e.email for e in user_emails.extra],
+                ['user@example.org'])
+            self.assertEqual([e.email for e in user_emails.unverified],
+                ['user@example.net'])
+            self.assertEqual(len(self.getQueries()), queries + 1)
+        finally:
+            settings.DEBUG = False
+
+
 class TestAccountSingleEmail(BaseTestCase):
     def setUp(self):
         self.user, self.user_email = self.createActiveUser()
@@ -423,7 +786,7 @@ class TestCleanup(BaseTestCase):
 
         email1 = UserEmail(user=user1, email='user1@example.com',
             verified=True, default=True, 
-            verification_key=UserEmail.VERIFIED + 'asd',
+            verification_key=UserEmail.VERIFIED,
             code_creation_date=old_enough)
         email1.save() 
 
@@ -433,7 +796,8 @@ class TestCleanup(BaseTestCase):
         email2 = UserEmail(user=user2, email='user2@example.com',
             verified=False, default=True, 
             verification_key='key1',
-            code_creation_date=old_enough)
+            code_creation_date=old_enough,
+            expires_at=datetime.now() - timedelta(days=1))
         email2.save()
 
         user3 = User(username='user3', email='user3@example.com', is_active=False)
@@ -442,7 +806,8 @@ class TestCleanup(BaseTestCase):
         email3 = UserEmail(user=user3, email='user3@example.com',
             verified=False, default=True, 
             verification_key='key2',
-            code_creation_date=not_old_enough)
+            code_creation_date=not_old_enough,
+            expires_at=datetime.now() + timedelta(days=1))
         email3.save()
 
         UserEmail.objects.delete_expired()
@@ -452,3 +817,693 @@ class TestCleanup(BaseTestCase):
 
         self.assertEqual(list(sorted(user_ids)), list(sorted([user1.id, user3.id])))
         self.assertEqual(list(sorted(user_email_ids)), list(sorted([email1.id, email3.id])))
+
+
+class TestReplicaRouter(BaseTestCase):
+    def setUp(self):
+        self.router = ReplicaRouter()
+        routers.reset()
+        settings.EMAILAUTH_REPLICA_DATABASES = ('replica',)
+
+    def tearDown(self):
+        routers.reset()
+        settings.EMAILAUTH_REPLICA_DATABASES = ()
+
+    def testRouting(self):
+        self.assertEqual(self.router.db_for_read(UserEmail), 'replica')
+        self.assertEqual(self.router.db_for_read(User), None)
+
+        self.assertEqual(self.router.db_for_write(UserEmail), 'default')
+        self.assertEqual(self.router.db_for_read(UserEmail), 'default')
+
+        routers.reset()
+        self.assertEqual(self.router.db_for_read(UserEmail), 'replica')
+
+        user = User()
+        user._state.db = 'replica'
+        self.assertEqual(self.router.db_for_write(User, instance=user),
+            'default')
+
+    def testSessionPinning(self):
+        class Request(object):
+            pass
+
+        middleware = ReplicaPinningMiddleware()
+        request = Request()
+        request.session = {}
+
+        middleware.process_request(request)
+        self.router.db_for_write(UserEmail)
+        middleware.process_response(request, None)
+        self.assertTrue(middleware.session_key in request.session)
+        self.assertEqual(self.router.db_for_read(UserEmail), 'replica')
+
+        middleware.process_request(request)
+        self.assertEqual(self.router.db_for_read(UserEmail), 'default')
+        middleware.process_response(request, None)
+
+        request.session[middleware.session_key] = 0
+        middleware.process_request(request)
+        self.assertEqual(self.router.db_for_read(UserEmail), 'replica')
+
+    def testUserPinning(self):
+        from django.contrib.auth import SESSION_KEY
+        from emailauth.backends import EmailBackend
+
+        class Request(object):
+            def __init__(self, session):
+                self.session = session
+
+        middleware = ReplicaPinningMiddleware()
+        user, user_email = self.createActiveUser('pinned',
+            'pinned@example.com')
+        routers.reset()
+
+        # Verification in one browser
+        middleware.process_request(Request({}))
+        email_obj = UserEmail.objects.create_unverified_email(
+            'pinned@example.org', user)
+        email_obj.save()
+        middleware.process_response(Request({}), None)
+
+        # The user's session in another browser
+        middleware.process_request(Request({SESSION_KEY: user.id}))
+        self.assertEqual(self.router.db_for_read(UserEmail), 'default')
+        middleware.process_response(Request({}), None)
+
+        # Login with the written address from a third one
+        middleware.process_request(Request({}))
+        self.assertEqual(self.router.db_for_read(UserEmail), 'replica')
+        EmailBackend().authenticate('pinned@example.org', 'password')
+        self.assertEqual(self.router.db_for_read(UserEmail), 'default')
+        middleware.process_response(Request({}), None)
+
+        middleware.process_request(Request({SESSION_KEY: user.id + 1}))
+        self.assertEqual(self.router.db_for_read(UserEmail), 'replica')
+
+    def testVerifyLagging(self):
+        user, user_email = self.createActiveUser()
+        email_obj = UserEmail.objects.create_unverified_email(
+            'user@example.org', user)
+        email_obj.save()
+        routers.reset()
+
+        # The replicas haven't seen the new email yet
+        manager = UserEmail.objects
+        select_related = manager.select_related
+
+        def lagging_select_related(*fields):
+            if routers.is_pinned():
+                return select_related(*fields)
+            return select_related(*fields).none()
+
+        manager.select_related = lagging_select_related
+        try:
+            verified = manager.verify(email_obj.verification_key)
+        finally:
+            del manager.select_related
+        self.assertEqual(verified.id, email_obj.id)
+
+
+class TestEmailIndex(BaseTestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'emails.bloom')
+        settings.EMAILAUTH_EMAIL_INDEX = self.path
+
+    def tearDown(self):
+        settings.EMAILAUTH_EMAIL_INDEX = None
+        shutil.rmtree(self.dir)
+
+    def testBloomFilter(self):
+        index = BloomFilter.create(self.path, 100, 0.01)
+        index.add(u'user@example.com')
+        self.assertTrue(u'user@example.com' in index)
+        self.assertFalse(u'user@example.org' in index)
+        index.close()
+
+    def testAvailability(self):
+        from django.core.management import call_command
+        user, user_email = self.createActiveUser()
+        call_command('buildemailindex')
+
+        self.assertTrue(UserEmail.objects.email_taken('user@example.com'))
+        self.assertFalse(UserEmail.objects.email_taken('user@example.org'))
+
+        UserEmail(user=user, email='user@example.org').save()
+        self.assertTrue(UserEmail.objects.email_taken('user@example.org'))
+
+        response = Client().get('/register/available/',
+            {'email': 'user@example.net'})
+        self.assertContains(response, '"available": true')
+
+    def testChangedEmail(self):
+        from django.core.management import call_command
+        user, user_email = self.createActiveUser()
+        call_command('buildemailindex')
+
+        user_email.email = 'user@example.org'
+        user_email.save()
+        self.assertTrue(UserEmail.objects.email_taken('user@example.org'))
+
+        # Emails changed behind the index's back hit the unique constraint
+        UserEmail.objects.filter(id=user_email.id).update(
+            email='user@example.net')
+        self.assertFalse(UserEmail.objects.email_taken('user@example.net'))
+        response = Client().post('/register/', {
+            'email': 'user@example.net',
+            'first_name': 'John',
+            'password1': 'password',
+            'password2': 'password',
+        })
+        self.assertStatusCode(response)
+        self.assertContains(response, 'This email is already taken.')
+        # Nothing is mailed for an email that wasn't stored
+        self.assertEqual(mail.outbox, [])
+
+    def testBrokenIndex(self):
+        from emailauth import emailindex
+        for content in ['', 'EABF', BloomFilter.HEADER.pack('EABF', 1024, 3)]:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            f = open(self.path, 'wb')
+            f.write(content)
+            f.close()
+            self.assertEqual(emailindex.get_index(), None)
+            self.assertFalse(UserEmail.objects.email_taken('user@example.com'))
+
+
+class TestUserEmailSummary(BaseTestCase):
+    def assertSummary(self, user, email_count, verified_count,
+        default_email_id):
+
+        summary = UserEmailSummary.objects.get(user=user)
+        self.assertEqual((summary.email_count, summary.verified_count,
+            summary.default_email_id),
+            (email_count, verified_count, default_email_id))
+
+    def testMaintained(self):
+        user, user_email = self.createActiveUser()
+        UserEmailSummary.objects.get_for_user(user.id)
+        self.assertSummary(user, 1, 1, user_email.id)
+
+        email_obj = UserEmail.objects.create_unverified_email(
+            'user@example.org', user)
+        email_obj.save()
+        self.assertSummary(user, 2, 1, user_email.id)
+
+        UserEmail.objects.verify(email_obj.verification_key)
+        self.assertSummary(user, 2, 2, user_email.id)
+
+        email_obj = UserEmail.objects.get(id=email_obj.id)
+        email_obj.default = True
+        email_obj.save()
+        self.assertSummary(user, 2, 2, email_obj.id)
+
+        email_obj.delete()
+        self.assertSummary(user, 1, 1, None)
+
+    def testReconcile(self):
+        from django.core.management import call_command
+        user, user_email = self.createActiveUser()
+        UserEmailSummary.objects.get_for_user(user.id)
+        UserEmailSummary.objects.filter(user=user).update(email_count=5)
+
+        call_command('reconcileemailsummaries', verbosity=0)
+        self.assertSummary(user, 1, 1, user_email.id)
+
+    def testCreateRace(self):
+        from django.db import IntegrityError
+        user, user_email = self.createActiveUser()
+        self.assertFalse(UserEmailSummary.objects.filter(user=user).exists())
+        reconcile = UserEmailSummary.objects.reconcile
+
+        def lose_race(user_ids):
+            # Another request creates the summary first
+            reconcile(user_ids)
+            raise IntegrityError('duplicate key')
+
+        UserEmailSummary.objects.reconcile = lose_race
+        try:
+            summary = UserEmailSummary.objects.get_for_user(user.id)
+        finally:
+            del UserEmailSummary.objects.reconcile
+        self.assertEqual(summary.email_count, 1)
+
+
+class TestCallerTransaction(TransactionTestCase):
+    def testRollback(self):
+        from django.db import transaction
+        user = User.objects.create(username='username', is_active=True)
+
+        transaction.enter_transaction_management()
+        transaction.managed(True)
+        try:
+            UserEmail(user=user, email='user@example.com', verified=True,
+                default=True, verification_key=UserEmail.VERIFIED).save()
+            UserEmailSummary.objects.reconcile([user.id])
+            transaction.rollback()
+        finally:
+            transaction.leave_transaction_management()
+
+        self.assertFalse(UserEmail.objects.filter(user=user).exists())
+        self.assertFalse(UserEmailSummary.objects.filter(user=user).exists())
+        self.assertEqual(User.objects.get(id=user.id).email, '')
+
+    def testViewRollback(self):
+        user = User(username='username', email='user@example.com',
+            is_active=True)
+        user.set_password('password')
+        user.save()
+        first = UserEmail(user=user, email='user@example.com', verified=True,
+            default=True, verification_key=UserEmail.VERIFIED)
+        first.save()
+        second = UserEmail(user=user, email='user@example.org', verified=True,
+            verification_key=UserEmail.VERIFIED)
+        second.save()
+        client = Client()
+        client.login(username='user@example.com', password='password')
+
+        def fail(*args, **kwds):
+            raise RuntimeError('summary update failed')
+
+        use_single = use_single_email()
+        settings.EMAILAUTH_USE_SINGLE_EMAIL = False
+        UserEmailSummary.objects.adjust = fail
+        try:
+            self.assertRaises(RuntimeError, client.post,
+                '/account/setdefaultemail/%s/' % second.id, {'yes': 'yes'})
+        finally:
+            del UserEmailSummary.objects.adjust
+            settings.EMAILAUTH_USE_SINGLE_EMAIL = use_single
+
+        self.assertTrue(UserEmail.objects.get(id=first.id).default)
+        self.assertFalse(UserEmail.objects.get(id=second.id).default)
+        self.assertEqual(User.objects.get(id=user.id).email,
+            'user@example.com')
+
+
+class TestProfilingMiddleware(BaseTestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        settings.EMAILAUTH_PROFILE_FILE = os.path.join(self.dir, 'profile.log')
+        settings.EMAILAUTH_PROFILE_FLUSH_INTERVAL = 0
+        self.middleware_classes = settings.MIDDLEWARE_CLASSES
+        settings.MIDDLEWARE_CLASSES = self.middleware_classes + (
+            'emailauth.middleware.ProfilingMiddleware',)
+
+    def tearDown(self):
+        from emailauth import profiling
+        settings.MIDDLEWARE_CLASSES = self.middleware_classes
+        settings.EMAILAUTH_PROFILE_FLUSH_INTERVAL = 60
+        if profiling._logger is not None:
+            for handler in list(profiling._logger.handlers):
+                profiling._logger.removeHandler(handler)
+                handler.close()
+            profiling._logger = None
+        shutil.rmtree(self.dir)
+
+    def testRecord(self):
+        from django.utils import simplejson
+        user, user_email = self.createActiveUser()
+        client = self.getLoggedInClient()
+        self.assertStatusCode(client.get('/account/'))
+
+        records = [simplejson.loads(line) for line in
+            open(settings.EMAILAUTH_PROFILE_FILE)]
+        account = [record for record in records if record['view'] == 'account']
+        self.assertEqual(account[0]['requests'], 1)
+        self.assertTrue(account[0]['queries'] > 0)
+
+    def testRecordNotModified(self):
+        from django.utils import simplejson
+        user, user_email = self.createActiveUser()
+        client = self.getLoggedInClient()
+        etag = client.get('/account/')['ETag']
+        response = client.get('/account/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        records = [simplejson.loads(line) for line in
+            open(settings.EMAILAUTH_PROFILE_FILE)]
+        self.assertEqual(sum([record['requests'] for record in records
+            if record['view'] == 'account']), 2)
+
+    def testRecordModeView(self):
+        from django.utils import simplejson
+        user, user_email = self.createActiveUser()
+        client = self.getLoggedInClient()
+        use_single = use_single_email()
+        settings.EMAILAUTH_USE_SINGLE_EMAIL = False
+        try:
+            self.assertStatusCode(client.get('/account/addemail/'))
+            self.assertStatusCode(client.post('/api/addemail/', {
+                'email': 'user@example.org'}))
+        finally:
+            settings.EMAILAUTH_USE_SINGLE_EMAIL = use_single
+
+        records = [simplejson.loads(line) for line in
+            open(settings.EMAILAUTH_PROFILE_FILE)]
+        self.assertEqual([record['view'] for record in records
+            if record['view'].endswith('add_email')],
+            ['add_email', 'api.add_email'])
+
+
+class TestStats(BaseTestCase):
+    def testStats(self):
+        from emailauth.stats import get_stats
+        user, user_email = self.createActiveUser()
+        email_obj = UserEmail.objects.create_unverified_email(
+            'user@example.org', user)
+        email_obj.save()
+        UserEmail(user=user, email='user@example.net', verification_key='key1',
+            expires_at=datetime.now() - timedelta(days=1)).save()
+
+        stats = get_stats(refresh=True)
+        self.assertEqual((stats['emails'], stats['verified'], stats['pending'],
+            stats['expired']), (3, 1, 1, 1))
+
+        settings.EMAILAUTH_STATS_INCREMENTAL = True
+        try:
+            UserEmail.objects.verify(email_obj.verification_key)
+            stats = get_stats()
+            self.assertEqual((stats['verified'], stats['pending']), (2, 0))
+
+            client = Client()
+            client.post('/register/', {
+                'email': 'new@example.com',
+                'first_name': 'John',
+                'password1': 'password',
+                'password2': 'password',
+            })
+            self.assertEqual(get_stats()['inactive_users'], 1)
+            new_email = UserEmail.objects.get(email='new@example.com')
+            client.get('/verify/%s/' % new_email.verification_key)
+            stats = get_stats()
+            self.assertEqual(stats['inactive_users'], 0)
+            self.assertEqual(stats, dict(get_stats(refresh=True),
+                computed_at=stats['computed_at']))
+        finally:
+            settings.EMAILAUTH_STATS_INCREMENTAL = False
+
+
+class TestDomainScheduler(BaseTestCase):
+    def testInterleaving(self):
+        import threading
+        import time
+        lock = threading.Lock()
+        sent = []
+        active = {}
+        max_active = {}
+
+        def send(domain, i):
+            lock.acquire()
+            active[domain] = active.get(domain, 0) + 1
+            max_active[domain] = max(max_active.get(domain, 0), active[domain])
+            lock.release()
+            time.sleep(0.01)
+            lock.acquire()
+            active[domain] -= 1
+            sent.append(domain)
+            lock.release()
+
+        scheduler = DomainScheduler(send, 4, 100,
+            {'example.com': {'rate': 50, 'concurrency': 1}})
+        for i in range(5):
+            scheduler.put('example.com', ('example.com', i))
+        for i in range(5):
+            scheduler.put('example.org', ('example.org', i))
+        scheduler.start()
+
+        self.assertTrue(scheduler.wait_idle(10))
+        self.assertEqual(len(sent), 10)
+        self.assertEqual(max_active['example.com'], 1)
+        self.assertEqual(max_active['example.org'], 2)
+        # Rate limited domain doesn't hold back the other one
+        self.assertEqual(sent[-1], 'example.com')
+
+
+class TestEvents(BaseTestCase):
+    def setUp(self):
+        from emailauth import events
+        self.received = []
+        events.email_verified.connect(self.receive)
+        events.email_added.connect(self.receive)
+
+    def tearDown(self):
+        from emailauth import events
+        events.email_verified.disconnect(self.receive)
+        events.email_added.disconnect(self.receive)
+        settings.EMAILAUTH_EVENT_DISPATCH = 'sync'
+
+    def receive(self, sender, events, **kwds):
+        self.received.append([(event['name'], event['email'])
+            for event in events])
+
+    def testSync(self):
+        user, user_email = self.createActiveUser()
+        email_obj = UserEmail.objects.create_unverified_email(
+            'user@example.org', user)
+        email_obj.save()
+        UserEmail.objects.verify(email_obj.verification_key)
+
+        self.assertEqual(self.received, [
+            [('email_added', 'user@example.com')],
+            [('email_verified', 'user@example.com')],
+            [('email_added', 'user@example.org')],
+            [('email_verified', 'user@example.org')],
+        ])
+
+    def testTable(self):
+        from django.core.management import call_command
+        from emailauth import events
+        from emailauth.models import PendingEvent
+        settings.EMAILAUTH_EVENT_DISPATCH = 'table'
+
+        self.createActiveUser()
+        self.createActiveUser('other', 'other@example.com')
+        self.assertEqual(self.received, [])
+        self.assertEqual(events.metrics()['depth'], 4)
+
+        call_command('dispatchemailauthevents', verbosity=0)
+        self.assertEqual(self.received, [
+            [('email_added', 'user@example.com'),
+                ('email_added', 'other@example.com')],
+            [('email_verified', 'user@example.com'),
+                ('email_verified', 'other@example.com')],
+        ])
+        self.assertEqual(PendingEvent.objects.count(), 0)
+
+
+class TestQueryCount(BaseTestCase):
+    def setUp(self):
+        settings.DEBUG = True
+
+    def tearDown(self):
+        settings.DEBUG = False
+
+    def selects(self, table):
+        return [query for query in self.getQueries()
+            if query['sql'].startswith('SELECT') and
+                ('FROM "%s"' % table) in query['sql']]
+
+    def testPasswordResetRequest(self):
+        self.createActiveUser()
+        client = Client()
+        response = client.post('/resetpassword/', {
+            'email': 'user@example.com',
+        })
+        self.assertStatusCode(response, Status.REDIRECT)
+        self.assertEqual(len(self.selects('emailauth_useremail')), 1)
+        self.assertEqual(len(self.selects('auth_user')), 0)
+
+    def testLogin(self):
+        self.createActiveUser()
+        client = Client()
+        response = client.post('/login/', {
+            'email': 'user@example.com',
+            'password': 'password',
+        })
+        self.assertStatusCode(response, Status.REDIRECT)
+        # The user comes with the email instead of a query of its own
+        queries = self.selects('emailauth_useremail')
+        self.assertEqual(len(queries), 1)
+        self.assertTrue('JOIN "auth_user"' in queries[0]['sql'])
+
+    def testDeleteEmail(self):
+        user, user_email = self.createActiveUser()
+        for email in ('user@example.org', 'user@example.net'):
+            UserEmail(user=user, email=email, verified=True,
+                verification_key=UserEmail.VERIFIED).save()
+        UserEmailSummary.objects.get_for_user(user.id)
+        client = self.getLoggedInClient()
+
+        for path in ('/account/deleteemail/%s/', '/api/deleteemail/%s/'):
+            email_id = UserEmail.objects.filter(user=user,
+                default=False)[0].id
+            self.resetQueries()
+            response = client.post(path % email_id, {'yes': 'yes'})
+            self.assertTrue(response.status_code in (Status.OK,
+                Status.REDIRECT))
+            # The counts are checked on the summary row and kept up to date
+            # without reading the emails again
+            self.assertEqual(len(self.selects('emailauth_useremail')), 1)
+            self.assertEqual(len(self.selects('emailauth_useremailsummary')),
+                1)
+            self.assertFalse(UserEmail.objects.filter(id=email_id).exists())
+
+
+class TestBulkEmails(BaseTestCase):
+    def testForUsers(self):
+        from emailauth.models import attach_emails
+        user, user_email = self.createActiveUser()
+        other, other_email = self.createActiveUser('other', 'other@example.com')
+        email_obj = UserEmail.objects.create_unverified_email(
+            'user@example.org', user)
+        email_obj.save()
+
+        emails = UserEmail.objects.for_users([user.id, other.id], chunk_size=1)
+        self.assertEqual([email.email for email in emails[user.id]],
+            ['user@example.com', 'user@example.org'])
+        self.assertEqual([email.email for email in emails[other.id]],
+            ['other@example.com'])
+
+        users = UserEmail.objects.users_for_emails(['user@example.com',
+            'user@example.org', 'other@example.com', 'nobody@example.com'])
+        self.assertEqual(users, {'user@example.com': user,
+            'other@example.com': other})
+
+        users = attach_emails(User.objects.order_by('id'), verified_only=True)
+        self.assertEqual([user.default_email.email for user in users],
+            ['user@example.com', 'other@example.com'])
+        self.assertEqual([len(user.emails) for user in users], [1, 1])
+
+
+class TestBounces(BaseTestCase):
+    DSN = """From mailer-daemon@example.net Mon Jan  4 10:00:00 2010
+From: Mail Delivery System <mailer-daemon@example.net>
+To: noreply@example.com
+Subject: Undelivered Mail Returned to Sender
+MIME-Version: 1.0
+Content-Type: multipart/report; report-type=delivery-status;
+    boundary="BOUNDARY"
+
+--BOUNDARY
+Content-Type: text/plain
+
+Delivery failed.
+
+--BOUNDARY
+Content-Type: message/delivery-status
+
+Reporting-MTA: dns; mx.example.net
+
+Final-Recipient: rfc822; %s
+Action: failed
+Status: 5.1.1
+
+Final-Recipient: rfc822; %s
+Action: delayed
+Status: 4.2.2
+
+--BOUNDARY--
+
+"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testIngest(self):
+        from django.core.management import call_command
+        user, user_email = self.createActiveUser()
+        other, other_email = self.createActiveUser('other', 'other@example.com')
+        third, third_email = self.createActiveUser('third', 'third@example.com')
+
+        mbox_path = os.path.join(self.dir, 'bounces')
+        f = open(mbox_path, 'w')
+        f.write(self.DSN % ('user@example.com', 'other@example.com'))
+        f.close()
+        jsonl_path = os.path.join(self.dir, 'bounces.jsonl')
+        f = open(jsonl_path, 'w')
+        f.write('{"email": "third@example.com", "type": "hard"}\n'
+            '{"email": "other@example.com", "type": "soft"}\n')
+        f.close()
+
+        call_command('ingestbounces', mbox_path, verbosity=0)
+        call_command('ingestbounces', jsonl_path, verbosity=0)
+        self.assertEqual(sorted(UserEmail.objects.filter(
+            bounced=True).values_list('email', flat=True)),
+            ['third@example.com', 'user@example.com'])
+
+        client = Client()
+        response = client.post('/resetpassword/', {
+            'email': 'user@example.com',
+        })
+        self.assertStatusCode(response, Status.REDIRECT)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(PasswordResetToken.objects.count(), 0)
+
+
+class TestAccountETag(BaseTestCase):
+    def setUp(self):
+        self.use_single_email = use_single_email()
+        settings.EMAILAUTH_USE_SINGLE_EMAIL = False
+
+    def tearDown(self):
+        settings.EMAILAUTH_USE_SINGLE_EMAIL = self.use_single_email
+
+    def testNotModified(self):
+        user, user_email = self.createActiveUser()
+        client = self.getLoggedInClient()
+
+        response = client.get('/account/')
+        self.assertStatusCode(response)
+        etag = response['ETag']
+
+        settings.DEBUG = True
+        try:
+            response = client.get('/account/', HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual([query for query in self.getQueries()
+                if 'FROM "emailauth_useremail"' in query['sql']], [])
+        finally:
+            settings.DEBUG = False
+
+        email_obj = UserEmail.objects.create_unverified_email(
+            'user@example.org', user)
+        email_obj.save()
+        response = client.get('/account/', HTTP_IF_NONE_MATCH=etag)
+        self.assertStatusCode(response)
+        self.assertContains(response, 'user@example.org')
+        self.assertNotEqual(response['ETag'], etag)
+
+    def testPendingMessages(self):
+        user, user_email = self.createActiveUser()
+        client = self.getLoggedInClient()
+        etag = client.get('/account/')['ETag']
+
+        user.message_set.create(message='Something happened')
+        response = client.get('/account/', HTTP_IF_NONE_MATCH=etag)
+        self.assertContains(response, 'Something happened')
+        self.assertFalse(response.has_header('ETag'))
+
+        response = client.get('/account/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+
+class TestHashBench(BaseTestCase):
+    def testHashAlgorithm(self):
+        from django.utils.hashcompat import md5_constructor
+        from emailauth.management.commands.emailauthhashbench import (
+            hash_algorithm, make_hash)
+        user = User(username='unusable')
+        user.set_unusable_password()
+
+        self.assertEqual(hash_algorithm(make_hash('sha1')), 'sha1')
+        self.assertEqual(hash_algorithm(
+            md5_constructor('password').hexdigest()), 'unsalted md5')
+        self.assertEqual(hash_algorithm(user.password), 'unusable')
+        self.assertEqual(hash_algorithm(''), 'unusable')
+        self.assertEqual(hash_algorithm('not a hash'), 'unknown')
@@ -8,10 +8,17 @@ urlpatterns = patterns('',
     url(r'^register/$', 'emailauth.views.register',
         name='register'),
 
+    url(r'^register/available/$', 'emailauth.views.email_available',
+        name='emailauth_email_available'),
+
     url(r'^register/continue/(?P<email>.+)/$',
         'emailauth.views.register_continue',
         name='emailauth_register_continue'),
 
+    url(r'^verify/registration/(?P<token>[\w.-]+)/$',
+        'emailauth.views.verify_registration',
+        name='emailauth_verify_registration'),
+
     url(r'^verify/(?P<verification_key>\w+)/$', 'emailauth.views.verify',
         name='emailauth_verify'),
 
@@ -45,6 +52,23 @@ urlpatterns = patterns('',
         'emailauth.views.set_default_email',
         name='emailauth_set_default_email'),
 
+    url(r'^api/login/$', 'emailauth.api.login', name='emailauth_api_login'),
+    url(r'^api/register/$', 'emailauth.api.register',
+        name='emailauth_api_register'),
+    url(r'^api/verify/$', 'emailauth.api.verify', name='emailauth_api_verify'),
+    url(r'^api/verify/code/$', 'emailauth.api.verify_code',
+        name='emailauth_api_verify_code'),
+    url(r'^api/resetpassword/$', 'emailauth.api.request_password_reset',
+        name='emailauth_api_request_password_reset'),
+    url(r'^api/resetpassword/confirm/$', 'emailauth.api.reset_password',
+        name='emailauth_api_reset_password'),
+    url(r'^api/addemail/$', 'emailauth.api.add_email',
+        name='emailauth_api_add_email'),
+    url(r'^api/deleteemail/(\d+)/$', 'emailauth.api.delete_email',
+        name='emailauth_api_delete_email'),
+    url(r'^api/setdefaultemail/(\d+)/$', 'emailauth.api.set_default_email',
+        name='emailauth_api_set_default_email'),
+
     url(r'^login/$', 'emailauth.views.login', name='login'),
     url(r'^logout/$', 'django.contrib.auth.views.logout', {'next_page': '/',
         'template_name': 'logged_out.html'}, name='logout'),
@@ -1,23 +1,99 @@
 from django.conf import settings
 from django.http import Http404
-from django.utils.functional import curry
+from django.utils.functional import curry, wraps
 
 def email_verification_days():
     return getattr(settings, 'EMAILAUTH_VERIFICATION_DAYS', 3)
 
+def password_reset_days():
+    return getattr(settings, 'EMAILAUTH_PASSWORD_RESET_DAYS',
+        email_verification_days())
+
 def use_single_email():
     return getattr(settings, 'EMAILAUTH_USE_SINGLE_EMAIL', True)
 
+def use_stateless_registration():
+    return getattr(settings, 'EMAILAUTH_STATELESS_REGISTRATION', False)
+
 def use_automaintenance():
     return getattr(settings, 'EMAILAUTH_USE_AUTOMAINTENANCE', True)
 
+def mail_workers():
+    return getattr(settings, 'EMAILAUTH_MAIL_WORKERS', 0)
+
+def mail_queue_size():
+    return getattr(settings, 'EMAILAUTH_MAIL_QUEUE_SIZE', 100)
+
+def mail_domain_limits():
+    return getattr(settings, 'EMAILAUTH_MAIL_DOMAIN_LIMITS', {})
+
+def mail_domain_rate():
+    return getattr(settings, 'EMAILAUTH_MAIL_DOMAIN_RATE', None)
+
+def mail_domain_concurrency():
+    return getattr(settings, 'EMAILAUTH_MAIL_DOMAIN_CONCURRENCY', 2)
+
+def email_index_path():
+    return getattr(settings, 'EMAILAUTH_EMAIL_INDEX', None)
+
+def login_cookie_check():
+    return getattr(settings, 'EMAILAUTH_LOGIN_COOKIE_CHECK', 'cookie')
+
+def replica_databases():
+    return getattr(settings, 'EMAILAUTH_REPLICA_DATABASES', ())
+
+def replica_pin_seconds():
+    return getattr(settings, 'EMAILAUTH_REPLICA_PIN_SECONDS', 10)
+
+def profile_file():
+    return getattr(settings, 'EMAILAUTH_PROFILE_FILE', 'emailauth-profile.log')
+
+def profile_file_size():
+    return getattr(settings, 'EMAILAUTH_PROFILE_FILE_SIZE', 10 * 1024 * 1024)
+
+def profile_file_count():
+    return getattr(settings, 'EMAILAUTH_PROFILE_FILE_COUNT', 5)
+
+def profile_flush_interval():
+    return getattr(settings, 'EMAILAUTH_PROFILE_FLUSH_INTERVAL', 60)
+
+def stats_cache_timeout():
+    return getattr(settings, 'EMAILAUTH_STATS_CACHE_TIMEOUT', 300)
+
+def use_incremental_stats():
+    return getattr(settings, 'EMAILAUTH_STATS_INCREMENTAL', False)
+
+def use_verification_codes():
+    return getattr(settings, 'EMAILAUTH_VERIFICATION_CODES', False)
+
+def verification_code_length():
+    return getattr(settings, 'EMAILAUTH_VERIFICATION_CODE_LENGTH', 6)
+
+def verification_code_attempts():
+    return getattr(settings, 'EMAILAUTH_VERIFICATION_CODE_ATTEMPTS', 5)
+
+def use_legacy_messages():
+    return getattr(settings, 'EMAILAUTH_LEGACY_MESSAGES', False)
+
+def event_dispatch_mode():
+    return getattr(settings, 'EMAILAUTH_EVENT_DISPATCH', 'sync')
+
+def event_queue_size():
+    return getattr(settings, 'EMAILAUTH_EVENT_QUEUE_SIZE', 1000)
+
+def event_batch_size():
+    return getattr(settings, 'EMAILAUTH_EVENT_BATCH_SIZE', 100)
+
+def event_batch_wait():
+    return getattr(settings, 'EMAILAUTH_EVENT_BATCH_WAIT', 0.5)
+
 def require_emailauth_mode(func, emailauth_use_singe_email):
     def wrapper(*args, **kwds):
         if use_single_email() == emailauth_use_singe_email:
             return func(*args, **kwds)
         else:
             raise Http404()
-    return wrapper
+    return wraps(func)(wrapper)
 
 requires_single_email_mode = curry(require_emailauth_mode,
     emailauth_use_singe_email=True)
@@ -1,17 +1,23 @@
-from datetime import datetime, timedelta
 from urllib import urlencode, quote_plus
 
-import django.core.mail
 from django.conf import settings
+from django.contrib import messages
 from django.contrib.auth import REDIRECT_FIELD_NAME
 from django.contrib.auth.models import User
 from django.contrib.sites.models import Site, RequestSite
 from django.core.urlresolvers import reverse
-from django.http import HttpResponseRedirect, Http404
+from django.http import HttpResponse, HttpResponseRedirect, Http404
 from django.shortcuts import render_to_response, get_object_or_404
 from django.template import RequestContext
 from django.template.loader import render_to_string
 from django.contrib.auth.decorators import login_required
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.utils import simplejson
+from django.utils.hashcompat import md5_constructor
+from django.utils.functional import wraps
+from django.views.decorators.http import condition
+from django.db import transaction, IntegrityError
 from django import forms
 import django.forms.forms
 import django.forms.util
@@ -21,10 +27,44 @@ from django.utils.translation import ugettext_lazy as _
 from emailauth.forms import (LoginForm, RegistrationForm,
     PasswordResetRequestForm, PasswordResetForm, AddEmailForm, DeleteEmailForm,
     ConfirmationForm)
-from emailauth.models import UserEmail
+from emailauth.models import (UserEmail, PasswordResetToken, UserSession,
+    UserEmailSummary)
+from emailauth.mail import send_mail
+from emailauth.context_processors import get_user_emails
+from emailauth import signing, events, stats
 
 from emailauth.utils import (use_single_email, requires_single_email_mode,
-    requires_multi_emails_mode, email_verification_days)
+    requires_multi_emails_mode, email_verification_days, password_reset_days,
+    login_cookie_check, use_stateless_registration, use_legacy_messages)
+
+
+def login_user(request, user):
+    from django.contrib.auth import login
+    if not hasattr(user, 'backend'):
+        user.backend = 'emailauth.backends.EmailBackend'
+    login(request, user)
+    UserSession.objects.add(user, request.session)
+
+
+def add_message(request, user, message):
+    # Without MessageMiddleware messages can only be stored in the database.
+    if use_legacy_messages() or not hasattr(request, '_messages'):
+        user.message_set.create(message=message)
+    else:
+        messages.info(request, message)
+
+
+def get_safe_redirect(redirect_to):
+    if not redirect_to or '//' in redirect_to or ' ' in redirect_to:
+        return settings.LOGIN_REDIRECT_URL
+    return redirect_to
+
+
+def cookies_enabled(request):
+    # With a session cookie sent back by the browser there's no need for a
+    # test cookie round trip.
+    return (login_cookie_check() == 'cookie' and
+        settings.SESSION_COOKIE_NAME in request.COOKIES)
 
 
 def login(request, template_name='emailauth/login.html',
@@ -35,13 +75,12 @@ def login(request, template_name='emailauth/login.html',
     if request.method == 'POST':
         form = LoginForm(request.POST)
         if form.is_valid():
-            from django.contrib.auth import login
-            login(request, form.get_user())
+            if request.session.test_cookie_worked():
+                request.session.delete_test_cookie()
+            login_user(request, form.get_user())
 
-            if request.get_host() == 'testserver':
-                if not redirect_to or '//' in redirect_to or ' ' in redirect_to:
-                    redirect_to = settings.LOGIN_REDIRECT_URL
-                return HttpResponseRedirect(redirect_to)
+            if request.get_host() == 'testserver' or cookies_enabled(request):
+                return HttpResponseRedirect(get_safe_redirect(redirect_to))
 
             request.session.set_test_cookie()
 
@@ -52,9 +91,7 @@ def login(request, template_name='emailauth/login.html',
     elif 'testcookiesupport' in request.GET:
         if request.session.test_cookie_worked():
             request.session.delete_test_cookie()
-            if not redirect_to or '//' in redirect_to or ' ' in redirect_to:
-                redirect_to = settings.LOGIN_REDIRECT_URL
-            return HttpResponseRedirect(redirect_to)
+            return HttpResponseRedirect(get_safe_redirect(redirect_to))
         else:
             form = LoginForm()
             errorlist = forms.util.ErrorList()
@@ -64,6 +101,12 @@ def login(request, template_name='emailauth/login.html',
             form._errors[forms.forms.NON_FIELD_ERRORS] = errorlist
     else:
         form = LoginForm()
+        if (login_cookie_check() == 'cookie' and
+            settings.SESSION_COOKIE_NAME not in request.COOKIES):
+
+            # Make sure that the session cookie is there when the form is
+            # submitted.
+            request.session.set_test_cookie()
 
     if Site._meta.installed:
         current_site = Site.objects.get_current()
@@ -78,7 +121,40 @@ def login(request, template_name='emailauth/login.html',
         context_instance=RequestContext(request))
 
 
+def has_pending_messages(request):
+    storage = getattr(request, '_messages', None)
+    if storage is not None:
+        # Counting loads the messages without marking them as shown.
+        return len(storage) > 0
+    return request.user.message_set.exists()
+
+
+def account_etag(request, template_name=None):
+    # Everything the account page shows: the user's emails (through the
+    # summary version) and the user itself, which is already loaded.
+    # Messages are shown only once, so a page with pending ones is never
+    # answered with 304 Not Modified.
+    user = request.user
+    if has_pending_messages(request):
+        return None
+    summary = UserEmailSummary.objects.get_for_user(user.id)
+    return md5_constructor(u':'.join([unicode(value) for value in [
+        user.id, summary.version, user.first_name, user.email,
+        template_name, use_single_email(),
+        getattr(request, 'LANGUAGE_CODE', settings.LANGUAGE_CODE),
+    ]]).encode('utf-8')).hexdigest()
+
+
+def etag_condition(etag_func):
+    # condition() doesn't keep the name and module of the view, which the
+    # profiling middleware relies on.
+    def decorator(view_func):
+        return wraps(view_func)(condition(etag_func=etag_func)(view_func))
+    return decorator
+
+
 @login_required
+@etag_condition(account_etag)
 def account(request, template_name=None):
     context = RequestContext(request)
 
@@ -88,16 +164,12 @@ def account(request, template_name=None):
         else:
             template_name = 'emailauth/account.html'
 
-    # Maybe move this emails into context processors?
-    extra_emails = UserEmail.objects.filter(user=request.user, default=False,
-        verified=True)
-    unverified_emails = UserEmail.objects.filter(user=request.user,
-        default=False, verified=False)
+    user_emails = get_user_emails(request)
 
     return render_to_response(template_name, 
         {
-            'extra_emails': extra_emails,
-            'unverified_emails': unverified_emails,
+            'extra_emails': user_emails.extra,
+            'unverified_emails': user_emails.unverified,
         },
         context_instance=context)
 
@@ -107,6 +179,14 @@ def get_max_length(model, field_name):
     return field.max_length
 
 
+def save_new_user(user):
+    user.save()
+    user.username = ('id_%d_%s' % (user.id, user.email))[
+        :get_max_length(User, 'username')]
+    user.save()
+    stats.user_created(user)
+
+
 def default_register_callback(form, email):
     data = form.cleaned_data
     user = User()
@@ -114,30 +194,99 @@ def default_register_callback(form, email):
     user.is_active = False
     user.email = email.email
     user.set_password(data['password1'])
-    user.save()
-    user.username = ('id_%d_%s' % (user.id, user.email))[
-        :get_max_length(User, 'username')]
-    user.save()
+    save_new_user(user)
     email.user = user
 
 
-def register(request, callback=default_register_callback):
-    if request.method == 'POST':
-        form = RegistrationForm(request.POST)
-        if form.is_valid():
-            email_obj = UserEmail.objects.create_unverified_email(
-                form.cleaned_data['email'])
-            email_obj.send_verification_email(form.cleaned_data['first_name'])
+REGISTRATION_SALT = 'emailauth.registration'
+
+
+def send_registration_email(form):
+    # Nothing is stored until the link is followed, everything needed to
+    # create the user travels in the signed link.
+    data = form.cleaned_data
+    user = User()
+    user.set_password(data['password1'])
+    token = signing.dumps({
+        'email': data['email'],
+        'first_name': data['first_name'],
+        'password': user.password,
+    }, REGISTRATION_SALT)
+
+    email_obj = UserEmail(email=data['email'], default=True)
+    email_obj.send_verification_email(data['first_name'],
+        verification_path=reverse('emailauth_verify_registration',
+        args=[token]))
+    return email_obj
+
+
+# Verification emails are sent only once the new email is committed: a
+# failed save must not mail out a key that was never stored, and the mail
+# server isn't waited on while the transaction holds its locks.
+
+@transaction.commit_on_success
+def register_email(form, callback=default_register_callback):
+    email_obj = UserEmail.objects.create_unverified_email(
+        form.cleaned_data['email'])
+    if callback is not None:
+        callback(form, email_obj)
+    email_obj.save()
+    return email_obj
+
+
+def _register_email(form, callback):
+    email_obj = register_email(form, callback)
+    email_obj.send_verification_email(form.cleaned_data['first_name'])
+    return email_obj
+
 
-            if callback is not None:
-                callback(form, email_obj)
+@transaction.commit_on_success
+def create_user_email(user, email, replace_others=False):
+    if replace_others:
+        UserEmail.objects.filter(user=user, default=False).delete()
+    email_obj = UserEmail.objects.create_unverified_email(email, user=user)
+    email_obj.save()
+    return email_obj
 
-            site = Site.objects.get_current()
-            email_obj.user.message_set.create(message='Welcome to %s.' % site.name)
 
-            email_obj.save()
+def _add_email(user, email):
+    email_obj = create_user_email(user, email)
+    email_obj.send_verification_email()
+    return email_obj
+
+
+def _change_email(user, email):
+    email_obj = create_user_email(user, email, replace_others=True)
+    email_obj.send_verification_email()
+    return email_obj
+
+
+def set_email_taken(form):
+    # The email index and the form's check only see committed emails, the
+    # unique constraint has the last word.
+    form._errors['email'] = form.error_class([
+        _(u'This email is already taken.')])
+
+
+def register(request, callback=default_register_callback):
+    if request.method == 'POST':
+        form = RegistrationForm(request.POST)
+        if form.is_valid() and use_stateless_registration():
+            email_obj = send_registration_email(form)
             return HttpResponseRedirect(reverse('emailauth_register_continue',
                 args=[quote_plus(email_obj.email)]))
+        elif form.is_valid():
+            try:
+                email_obj = _register_email(form, callback)
+            except IntegrityError:
+                set_email_taken(form)
+            else:
+                site = Site.objects.get_current()
+                add_message(request, email_obj.user,
+                    'Welcome to %s.' % site.name)
+                return HttpResponseRedirect(reverse(
+                    'emailauth_register_continue',
+                    args=[quote_plus(email_obj.email)]))
     else:
         form = RegistrationForm()
 
@@ -145,6 +294,22 @@ def register(request, callback=default_register_callback):
         RequestContext(request))
 
 
+def email_available(request):
+    email = request.GET.get('email', '')
+    try:
+        validate_email(email)
+    except ValidationError:
+        available = False
+    else:
+        available = not UserEmail.objects.email_taken(email)
+
+    return HttpResponse(simplejson.dumps({
+            'email': email,
+            'available': available,
+        }),
+        mimetype='application/json')
+
+
 def register_continue(request, email,
     template_name='emailauth/register_continue.html'):
 
@@ -152,35 +317,102 @@ def register_continue(request, email,
         RequestContext(request))
 
 
-def default_verify_callback(request, email):
-    email.user.is_active = True
-    email.user.save()
+def activate_user(request, email):
+    if not email.user.is_active:
+        if User.objects.filter(pk=email.user_id, is_active=False).update(
+            is_active=True):
+
+            stats.user_activated()
+        email.user.is_active = True
 
     if request.user.is_anonymous():
-        from django.contrib.auth import login
-        user = email.user
-        user.backend = 'emailauth.backends.EmailBackend'
-        login(request, user)
+        login_user(request, email.user)
+
+
+def default_verify_callback(request, email):
+    was_anonymous = request.user.is_anonymous()
+    activate_user(request, email)
+
+    if was_anonymous:
         return HttpResponseRedirect(settings.LOGIN_REDIRECT_URL)
     else:
         return HttpResponseRedirect(reverse('emailauth_account'))
 
 
+@transaction.commit_on_success
+def _verify_email(request, verification_key, callback, email_address=None):
+    if email_address is not None:
+        email = UserEmail.objects.verify_code(email_address, verification_key)
+    else:
+        email = UserEmail.objects.verify(verification_key)
+    if email is None:
+        return None, None
+
+    add_message(request, email.user, _('%s email confirmed.') % email.email)
+
+    if callback is not None:
+        return email, callback(request, email)
+    return email, None
+
+
 def verify(request, verification_key, template_name='emailauth/verify.html',
     extra_context=None, callback=default_verify_callback):
 
     verification_key = verification_key.lower() # Normalize before trying anything with it.
-    email = UserEmail.objects.verify(verification_key)
+    email, cb_result = _verify_email(request, verification_key, callback)
+    if cb_result is not None:
+        return cb_result
+
+    context = RequestContext(request)
+    if extra_context is not None:
+        for key, value in extra_context.items():
+            context[key] = value() if callable(value) else value
 
-    
-    if email is not None:
-        email.user.message_set.create(message=_('%s email confirmed.') % email.email)
+    return render_to_response(template_name,
+        {
+            'email': email,
+            'expiration_days': email_verification_days(),
+        },
+        context_instance=context)
 
-        if use_single_email():
-            email.default = True
-            email.save()
-            UserEmail.objects.filter(user=email.user, default=False).delete()
 
+@transaction.commit_on_success
+def _create_registered_user(data):
+    if UserEmail.objects.filter(email=data['email']).exists():
+        return None
+
+    user = User()
+    user.first_name = data['first_name']
+    user.is_active = True
+    user.email = data['email']
+    user.password = data['password']
+    save_new_user(user)
+
+    email = UserEmail(user=user, email=data['email'], default=True,
+        verified=True, verification_key=UserEmail.VERIFIED)
+    email.save()
+    return email
+
+
+def create_registered_user(token):
+    try:
+        data = signing.loads(token, REGISTRATION_SALT,
+            email_verification_days() * 24 * 60 * 60)
+    except signing.BadSignature:
+        return None
+
+    try:
+        return _create_registered_user(data)
+    except IntegrityError:
+        # Somebody has just taken this email
+        return None
+
+
+def verify_registration(request, token,
+    template_name='emailauth/verify.html', extra_context=None,
+    callback=default_verify_callback):
+
+    email = create_registered_user(token)
     if email is not None and callback is not None:
         cb_result = callback(request, email)
         if cb_result is not None:
@@ -199,6 +431,31 @@ def verify(request, verification_key, template_name='emailauth/verify.html',
         context_instance=context)
 
 
+def send_password_reset_email(user_email):
+    if user_email.bounced:
+        return None
+
+    token = PasswordResetToken.objects.create_token(user_email)
+
+    current_site = Site.objects.get_current()
+
+    subject = render_to_string(
+        'emailauth/request_password_email_subject.txt',
+        {'site': current_site})
+    # Email subject *must not* contain newlines
+    subject = ''.join(subject.splitlines())
+
+    message = render_to_string('emailauth/request_password_email.txt', {
+        'reset_code': token.key,
+        'expiration_days': password_reset_days(),
+        'site': current_site,
+        'first_name': user_email.user.first_name,
+    })
+
+    send_mail(subject, message, [user_email.email])
+    return token
+
+
 def request_password_reset(request,
     template_name='emailauth/request_password.html'):
 
@@ -206,27 +463,7 @@ def request_password_reset(request,
         form = PasswordResetRequestForm(request.POST)
         if form.is_valid():
             email = form.cleaned_data['email']
-            user_email = UserEmail.objects.get(email=email)
-            user_email.make_new_key()
-            user_email.save()
-
-            current_site = Site.objects.get_current()
-
-            subject = render_to_string(
-                'emailauth/request_password_email_subject.txt',
-                {'site': current_site})
-            # Email subject *must not* contain newlines
-            subject = ''.join(subject.splitlines())
-
-            message = render_to_string('emailauth/request_password_email.txt', {
-                'reset_code': user_email.verification_key,
-                'expiration_days': email_verification_days(),
-                'site': current_site,
-                'first_name': user_email.user.first_name,
-            })
-
-            django.core.mail.send_mail(subject, message,
-                settings.DEFAULT_FROM_EMAIL, [email])
+            send_password_reset_email(form.user_email)
 
             return HttpResponseRedirect(
                 reverse('emailauth_request_password_reset_continue',
@@ -238,7 +475,7 @@ def request_password_reset(request,
     return render_to_response(template_name,
         {
             'form': form,
-            'expiration_days': email_verification_days(),
+            'expiration_days': password_reset_days(),
         },
         context_instance=context)
 
@@ -251,29 +488,35 @@ def request_password_reset_continue(request, email,
         context_instance=RequestContext(request))
 
 
+def set_new_password(request, token, password):
+    if not PasswordResetToken.objects.consume(token):
+        return None
+
+    user = token.user_email.user
+    user.set_password(password)
+    user.save()
+
+    login_user(request, user)
+    UserSession.objects.invalidate(user, request.session.session_key)
+    events.emit('password_reset', user_id=user.id,
+        email_id=token.user_email_id, email=token.user_email.email)
+    return user
+
+
 def reset_password(request, reset_code,
     template_name='emailauth/reset_password.html'):
 
-    user_email = get_object_or_404(UserEmail, verification_key=reset_code)
-    if (user_email.verification_key == UserEmail.VERIFIED or
-        user_email.code_creation_date +
-        timedelta(days=email_verification_days()) < datetime.now()):
-
+    token = PasswordResetToken.objects.get_valid(reset_code)
+    if token is None:
         raise Http404()
 
     if request.method == 'POST':
         form = PasswordResetForm(request.POST)
         if form.is_valid():
-            user = user_email.user
-            user.set_password(form.cleaned_data['password1'])
-            user.save()
+            if set_new_password(request, token,
+                form.cleaned_data['password1']) is None:
 
-            user_email.verification_key = UserEmail.VERIFIED
-            user_email.save()
-
-            from django.contrib.auth import login
-            user.backend = 'emailauth.backends.EmailBackend'
-            login(request, user)
+                raise Http404()
             return HttpResponseRedirect(reverse('emailauth_account'))
     else:
         form = PasswordResetForm()
@@ -290,12 +533,15 @@ def add_email(request, template_name='emailauth/add_email.html'):
     if request.method == 'POST':
         form = AddEmailForm(request.POST)
         if form.is_valid():
-            email_obj = UserEmail.objects.create_unverified_email(
-                form.cleaned_data['email'], user=request.user)
-            email_obj.send_verification_email()
-            email_obj.save()
-            return HttpResponseRedirect(reverse('emailauth_add_email_continue',
-                args=[quote_plus(email_obj.email)]))
+            try:
+                email_obj = _add_email(request.user,
+                    form.cleaned_data['email'])
+            except IntegrityError:
+                set_email_taken(form)
+            else:
+                return HttpResponseRedirect(reverse(
+                    'emailauth_add_email_continue',
+                    args=[quote_plus(email_obj.email)]))
     else:
         form = AddEmailForm()
 
@@ -321,15 +567,17 @@ def change_email(request, template_name='emailauth/change_email.html'):
     if request.method == 'POST':
         form = AddEmailForm(request.POST)
         if form.is_valid():
-            UserEmail.objects.filter(user=request.user, default=False).delete()
-
-            email_obj = UserEmail.objects.create_unverified_email(
-                form.cleaned_data['email'], user=request.user)
-            email_obj.send_verification_email()
-            email_obj.save()
-
-            return HttpResponseRedirect(reverse('emailauth_change_email_continue',
-                args=[quote_plus(email_obj.email)]))
+            try:
+                email_obj = _change_email(request.user,
+                    form.cleaned_data['email'])
+            except IntegrityError:
+                set_email_taken(form)
+            else:
+                UserSession.objects.invalidate(request.user,
+                    request.session.session_key)
+                return HttpResponseRedirect(reverse(
+                    'emailauth_change_email_continue',
+                    args=[quote_plus(email_obj.email)]))
     else:
         form = AddEmailForm()
 
@@ -351,6 +599,7 @@ def change_email_continue(request, email,
 
 @requires_multi_emails_mode
 @login_required
+@transaction.commit_on_success
 def delete_email(request, email_id,
     template_name='emailauth/delete_email.html'):
 
@@ -361,6 +610,8 @@ def delete_email(request, email_id,
         form = DeleteEmailForm(request.user, request.POST)
         if form.is_valid():
             user_email.delete()
+            UserSession.objects.invalidate(request.user,
+                request.session.session_key)
 
             # Not really sure, where I should redirect from here...
             return HttpResponseRedirect(reverse('emailauth_account'))
@@ -375,6 +626,7 @@ def delete_email(request, email_id,
 
 @requires_multi_emails_mode
 @login_required
+@transaction.commit_on_success
 def set_default_email(request, email_id,
     template_name='emailauth/set_default_email.html'):
 
@@ -396,10 +648,17 @@ def set_default_email(request, email_id,
         context_instance=context)
 
 
+@transaction.commit_on_success
+def _renew_verification(user_email):
+    user_email.set_expiration()
+    user_email.save()
+
+
 @login_required
 def resend_verification_email(request, email_id):
     user_email = get_object_or_404(UserEmail, id=email_id, user=request.user,
         verified=False)
+    _renew_verification(user_email)
     user_email.send_verification_email()
 
     return HttpResponseRedirect(reverse('emailauth_add_email_continue',
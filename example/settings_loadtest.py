@@ -0,0 +1,9 @@
+from settings import *
+
+EMAIL_BACKEND = 'django.core.mail.backends.filebased.EmailBackend'
+EMAIL_FILE_PATH = join(PROJECT_ROOT, 'loadtest-mail')
+
+# Load test follows verification links by path, so there's no need to keep
+# the site domain up to date on every request.
+MIDDLEWARE_CLASSES = tuple(middleware for middleware in MIDDLEWARE_CLASSES
+    if middleware != 'example.middleware.CurrentSiteMiddleware')
@@ -0,0 +1,29 @@
+from settings import *
+
+# There is no real replication between these two databases, when running
+# tests 'replica' mirrors 'default'. The test database is a file, so that the
+# replica connection sees it too (each connection to an in-memory SQLite
+# database has its own database). Django 1.2 doesn't tell whether mirrors
+# support transactions; they are treated as not supporting them, so tests
+# commit their data where the replica connection can read it.
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': DATABASE_NAME,
+        'TEST_NAME': join(PROJECT_ROOT, 'emailauth_test.db'),
+    },
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': join(PROJECT_ROOT, 'emailauth_replica.db'),
+        'TEST_MIRROR': 'default',
+        'SUPPORTS_TRANSACTIONS': False,
+    },
+}
+
+DATABASE_ROUTERS = ['emailauth.routers.ReplicaRouter']
+
+EMAILAUTH_REPLICA_DATABASES = ('replica',)
+
+MIDDLEWARE_CLASSES = MIDDLEWARE_CLASSES + (
+    'emailauth.middleware.ReplicaPinningMiddleware',
+)